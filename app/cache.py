@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# What the ride endpoints need to know about a user resolved from an alias.
+UserRef = namedtuple("UserRef", ["id", "carPlate"])
+
+class AliasCache:
+    """Bounded LRU cache with a TTL mapping aliases to UserRef records."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0, enabled: bool = True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, alias: str):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(alias)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(alias)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[alias]
+            self.misses += 1
+            return None
+
+    def put(self, alias: str, ref: UserRef):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[alias] = (ref, time.monotonic() + self.ttl)
+            self._entries.move_to_end(alias)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, alias: str):
+        with self._lock:
+            self._entries.pop(alias, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,37 +1,356 @@
-from sqlalchemy.orm import Session
+import base64
+import functools
+import json
+import os
+import re
+from datetime import datetime
+from sqlalchemy import case, exists, insert, select, text, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from . import metrics
+from .cache import AliasCache, UserRef
+from .database.database import create_writer_sessionmaker
+from .group_commit import GroupCommitter
+from .matching import RideIndex
 from .models import models
+from typing import List
 from .schemas.schemas import UserCreate, RideCreate, RideParticipationCreate
 
+# Loading profiles for queries returning rides. "ride_full" loads everything
+# serialized by schemas.Ride in a fixed number of queries (rides + driver in
+# one JOIN, then one SELECT for participations with their users);
+# "ride_summary" only brings the driver along and "ride_only" loads nothing
+# else, for handlers that just need the ride's own columns.
+LOAD_PROFILES = {
+    "ride_full": (
+        joinedload(models.Ride.rideDriver),
+        selectinload(models.Ride.participants).joinedload(models.RideParticipation.participant),
+    ),
+    "ride_summary": (
+        joinedload(models.Ride.rideDriver),
+    ),
+    "ride_only": (),
+}
+
+alias_cache = AliasCache(
+    maxsize=int(os.getenv("ALIAS_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ALIAS_CACHE_TTL", "300")),
+    enabled=os.getenv("ALIAS_CACHE_ENABLED", "1") != "0",
+)
+
+def _alias_cache_metrics():
+    stats = alias_cache.stats()
+    return [
+        ("alias_cache_hits_total", "counter", "Alias lookups served from the alias cache.", stats["hits"]),
+        ("alias_cache_misses_total", "counter", "Alias lookups that went to the database.", stats["misses"]),
+        ("alias_cache_size", "gauge", "Aliases currently held in the alias cache.", stats["size"]),
+    ]
+
+metrics.registry.register_collector(_alias_cache_metrics)
+
+ride_index = RideIndex(max_age=float(os.getenv("RIDE_INDEX_MAX_AGE", "30")))
+
+# Disabled unless GROUP_COMMIT_WINDOW_MS is set; see app/group_commit.py.
+commit_queue = GroupCommitter(create_writer_sessionmaker)
+
+class ConflictError(Exception):
+    """A row changed between being read and being written; retrying the request re-reads it."""
+
+def _write(db: Session, job, *args):
+    # Runs job(db, *args) and commits it: in the request's session, or in the
+    # next group commit when commit_queue is enabled. An ORM result from the
+    # writer is merged into the request's session so it can lazy-load there.
+    try:
+        if commit_queue.enabled:
+            result = commit_queue.submit(job, *args)
+            return db.merge(result, load=False) if result is not None else None
+        try:
+            result = job(db, *args)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return result
+    except StaleDataError:
+        # Raised by the ORM flush when a versioned row (version_id_col) changed.
+        raise ConflictError("The row was modified by another request")
+
+def _versioned(column, expected):
+    # Optimistic check for Core UPDATEs: only matches if the row still has
+    # the version the caller read. None skips the check.
+    return column == expected if expected is not None else True
+
+def _query_rides(db: Session, profile: str = "ride_full"):
+    return db.query(models.Ride).options(*LOAD_PROFILES[profile])
+
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    # Raises ValueError on anything that was not produced by encode_cursor.
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+def ride_cursor(ride):
+    return encode_cursor(ride.rideDateAndTime, ride.id)
+
+def user_cursor(user):
+    return encode_cursor(user.id)
+
+def participation_cursor(participation):
+    return encode_cursor(participation.id)
+
+def _decode_ride_cursor(cursor: str):
+    values = decode_cursor(cursor)
+    if len(values) != 2 or not isinstance(values[0], str) or not isinstance(values[1], int):
+        raise ValueError("Invalid cursor")
+    return datetime.fromisoformat(values[0]), values[1]
+
+def _decode_id_cursor(cursor: str):
+    values = decode_cursor(cursor)
+    if len(values) != 1 or not isinstance(values[0], int):
+        raise ValueError("Invalid cursor")
+    return values[0]
+
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
 def get_user_by_alias(db: Session, alias: str):
     return db.query(models.User).filter(models.User.alias == alias).first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def resolve_alias(db: Session, alias: str):
+    # Returns a UserRef (id, carPlate) for the alias, served from alias_cache
+    # when possible, or None if no user has that alias.
+    ref = alias_cache.get(alias)
+    if ref is None:
+        row = db.query(models.User.id, models.User.carPlate).filter(models.User.alias == alias).first()
+        if row is None:
+            return None
+        ref = UserRef(row.id, row.carPlate)
+        alias_cache.put(alias, ref)
+    return ref
 
-def create_user(db: Session, user: UserCreate):
+def get_users(db: Session, skip: int = 0, limit: int = 100, cursor: str = None):
+    query = db.query(models.User).order_by(models.User.id)
+    if cursor:
+        query = query.filter(models.User.id > _decode_id_cursor(cursor))
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
+
+def _add_user(db: Session, user: UserCreate):
     db_user = models.User(alias=user.alias, name=user.name, carPlate=user.carPlate)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
     return db_user
 
-def get_ride(db: Session, ride_id: int):
-    return db.query(models.Ride).filter(models.Ride.id == ride_id).first()
+def create_user(db: Session, user: UserCreate):
+    db_user = _write(db, _add_user, user)
+    alias_cache.invalidate(user.alias)
+    return db_user
+
+BULK_CHUNK_SIZE = 500
+
+def _existing_aliases(db: Session, aliases):
+    aliases = list(aliases)
+    existing = set()
+    for start in range(0, len(aliases), BULK_CHUNK_SIZE):
+        chunk = aliases[start:start + BULK_CHUNK_SIZE]
+        existing.update(db.scalars(select(models.User.alias).where(models.User.alias.in_(chunk))))
+    return existing
+
+def create_users_bulk(db: Session, users: List[UserCreate]):
+    # One IN lookup for the aliases already taken, then a single multi-row
+    # INSERT ... RETURNING in one transaction. Results keep the input order;
+    # repeated aliases within the batch count as duplicates after the first.
+    for attempt in range(2):
+        existing = _existing_aliases(db, {user.alias for user in users})
+        results, rows, seen = [], [], set()
+        for user in users:
+            if user.alias in existing or user.alias in seen:
+                results.append({"alias": user.alias, "status": "duplicate"})
+                continue
+            seen.add(user.alias)
+            rows.append({"alias": user.alias, "name": user.name, "carPlate": user.carPlate})
+            results.append({"alias": user.alias, "status": "created"})
+        try:
+            ids = {}
+            if rows:
+                # Ids are matched back by alias, so the RETURNING rows need no
+                # particular order; asking for parameter order makes SQLite
+                # fall back to one INSERT per row.
+                inserted = db.execute(insert(models.User).returning(models.User.id, models.User.alias), rows)
+                ids = {alias: user_id for user_id, alias in inserted}
+            db.commit()
+        except IntegrityError:
+            # Another request registered one of the aliases in the meantime.
+            db.rollback()
+            if attempt:
+                raise
+            continue
+        for result in results:
+            if result["status"] == "created":
+                result["id"] = ids[result["alias"]]
+                alias_cache.invalidate(result["alias"])
+        return results
+
+def get_ride(db: Session, ride_id: int, profile: str = "ride_full"):
+    return _query_rides(db, profile).filter(models.Ride.id == ride_id).first()
+
+def _ride_page(query, skip: int, limit: int, cursor: str, date_from: datetime = None, date_to: datetime = None,
+               min_free_seats: int = None, sort: str = "date"):
+    # Ready rides ordered by (rideDateAndTime, id), ascending for "date" and
+    # descending for "-date"; the date range is served by ix_rides_status_date_id.
+    key = tuple_(models.Ride.rideDateAndTime, models.Ride.id)
+    query = query.filter(models.Ride.status == "ready")
+    if date_from:
+        query = query.filter(models.Ride.rideDateAndTime >= date_from)
+    if date_to:
+        query = query.filter(models.Ride.rideDateAndTime < date_to)
+    if min_free_seats is not None:
+        query = query.filter(models.Ride.freeSeats >= min_free_seats)
+    if sort == "-date":
+        query = query.order_by(models.Ride.rideDateAndTime.desc(), models.Ride.id.desc())
+    else:
+        query = query.order_by(models.Ride.rideDateAndTime, models.Ride.id)
+    if cursor:
+        after = tuple_(*_decode_ride_cursor(cursor))
+        query = query.filter(key < after if sort == "-date" else key > after)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
+
+def get_rides(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, profile: str = "ride_full", **filters):
+    return _ride_page(_query_rides(db, profile), skip, limit, cursor, **filters).all()
+
+# Columns a client can pick with fields= (or all of them with view=summary);
+# these match schemas.RideSummary.
+RIDE_SUMMARY_COLUMNS = {
+    "id": models.Ride.id,
+    "rideDateAndTime": models.Ride.rideDateAndTime,
+    "finalAddress": models.Ride.finalAddress,
+    "allowedSpaces": models.Ride.allowedSpaces,
+    "status": models.Ride.status,
+    "freeSeats": models.Ride.freeSeats.label("freeSeats"),
+}
+
+def _ride_key_columns(fields):
+    # id, rideDateAndTime and version are always selected: they drive the
+    # keyset cursor and the ETag.
+    columns = [models.Ride.id, models.Ride.rideDateAndTime, models.Ride.version]
+    return columns + [RIDE_SUMMARY_COLUMNS[f] for f in fields if f not in ("id", "rideDateAndTime")]
+
+def get_ride_versions(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, fields=(), **filters):
+    # Same page as get_rides, but only plain columns: the ETag keys plus any
+    # requested summary fields. No relationship is loaded.
+    return _ride_page(db.query(*_ride_key_columns(fields)), skip, limit, cursor, **filters).all()
 
-def get_rides(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Ride).filter(models.Ride.status == "ready").offset(skip).limit(limit).all()
+def get_rides_by_ids(db: Session, ride_ids: list, profile: str = "ride_full"):
+    rides = {ride.id: ride for ride in _query_rides(db, profile).filter(models.Ride.id.in_(ride_ids))}
+    return [rides[ride_id] for ride_id in ride_ids if ride_id in rides]
+
+def _fts_query(q: str):
+    # Every word of the input must match, as a prefix; quoting each token
+    # keeps FTS5 operators in user input from being interpreted.
+    return " ".join(f'"{token}"*' for token in re.findall(r"\w+", q))
+
+def search_rides(db: Session, q: str, skip: int = 0, limit: int = 100, status: str = "ready"):
+    match = _fts_query(q)
+    if not match:
+        return []
+    ride_ids = db.execute(
+        text(
+            "SELECT rides.id FROM rides_fts JOIN rides ON rides.id = rides_fts.rowid "
+            "WHERE rides_fts MATCH :match AND rides.status = :status "
+            "ORDER BY bm25(rides_fts, 2.0, 1.0), rides.id LIMIT :limit OFFSET :skip"
+        ),
+        {"match": match, "status": status, "limit": limit, "skip": skip}
+    ).scalars().all()
+    return get_rides_by_ids(db, ride_ids)
+
+def get_ride_version(db: Session, ride_id: int):
+    return db.query(models.Ride.version).filter(models.Ride.id == ride_id).scalar()
+
+def _driver_ride_page(query, driver_id: int, limit: int, cursor: str, status: str = None):
+    # A driver's rides ordered by (rideDateAndTime, id), served by ix_rides_driver_date.
+    query = query.filter(models.Ride.driver_id == driver_id)
+    if status:
+        query = query.filter(models.Ride.status == status)
+    if cursor:
+        query = query.filter(tuple_(models.Ride.rideDateAndTime, models.Ride.id) > tuple_(*_decode_ride_cursor(cursor)))
+    return query.order_by(models.Ride.rideDateAndTime, models.Ride.id).limit(limit)
+
+def get_rides_by_driver(db: Session, driver_id: int, limit: int = 100, cursor: str = None, status: str = None,
+                        profile: str = "ride_full"):
+    return _driver_ride_page(_query_rides(db, profile), driver_id, limit, cursor, status).all()
+
+EXPORT_BATCH_SIZE = 500
+
+def iter_ride_batches(db: Session, status: str = None, date_from: datetime = None, date_to: datetime = None,
+                      batch_size: int = None):
+    # Streams rides (with driver and participations) in batches of batch_size
+    # using a server-side cursor. Each batch is dropped from the session once
+    # the caller is done with it, so memory does not grow with the table.
+    # (expunge_all() cannot be used: the result keeps loading into the
+    # session's identity map between batches.)
+    query = select(models.Ride).options(*LOAD_PROFILES["ride_full"]).order_by(models.Ride.id)
+    if status:
+        query = query.filter(models.Ride.status == status)
+    if date_from:
+        query = query.filter(models.Ride.rideDateAndTime >= date_from)
+    if date_to:
+        query = query.filter(models.Ride.rideDateAndTime < date_to)
+    result = db.execute(query.execution_options(yield_per=batch_size or EXPORT_BATCH_SIZE))
+    for batch in result.scalars().partitions():
+        yield batch
+        for ride in batch:
+            # rideDriver is None for rides without a driver; a driver or
+            # participant shared with an earlier ride is already expunged.
+            for instance in [ride, ride.rideDriver, *ride.participants, *(p.participant for p in ride.participants)]:
+                if instance is not None and instance in db:
+                    db.expunge(instance)
+
+def get_ride_versions_by_driver(db: Session, driver_id: int, limit: int = 100, cursor: str = None, status: str = None,
+                                fields=()):
+    return _driver_ride_page(db.query(*_ride_key_columns(fields)), driver_id, limit, cursor, status).all()
+
+def get_user_participations(db: Session, participant_id: int, limit: int = 100, cursor: str = None, status: str = None):
+    # Served by ix_ride_participations_participant_status; ordered by id.
+    query = db.query(models.RideParticipation).options(joinedload(models.RideParticipation.ride)) \
+        .filter(models.RideParticipation.participant_id == participant_id)
+    if status:
+        query = query.filter(models.RideParticipation.status == status)
+    if cursor:
+        query = query.filter(models.RideParticipation.id > _decode_id_cursor(cursor))
+    return query.order_by(models.RideParticipation.id).limit(limit).all()
+
+def _bump_ride_version(db: Session, ride_id: int):
+    db.execute(
+        update(models.Ride)
+        .where(models.Ride.id == ride_id)
+        .values(version=models.Ride.version + 1)
+        .execution_options(synchronize_session=False)
+    )
 
 def create_ride(db: Session, ride: RideCreate, driver_id: int):
     db_ride = models.Ride(**ride.dict(), driver_id=driver_id)
     db.add(db_ride)
+    db.flush()
+    ride_id = db_ride.id
     db.commit()
-    db.refresh(db_ride)
+    db_ride = get_ride(db, ride_id=ride_id)
+    ride_index.add(ride_id, db_ride.rideDateAndTime, db_ride.finalAddress, db_ride.freeSeats, driver_id)
     return db_ride
 
-def create_ride_participation(db: Session, ride_id: int, user_id: int, details: RideParticipationCreate):
+def _add_ride_participation(db: Session, ride_id: int, user_id: int, details: RideParticipationCreate):
     db_participation = models.RideParticipation(
         ride_id=ride_id,
         participant_id=user_id,
@@ -39,6 +358,153 @@ def create_ride_participation(db: Session, ride_id: int, user_id: int, details:
         occupiedSpaces=details.occupiedSpaces
     )
     db.add(db_participation)
-    db.commit()
-    db.refresh(db_participation)
+    try:
+        db.flush()
+    except IntegrityError:
+        # UNIQUE(ride_id, participant_id)
+        raise ValueError("Participant has already requested to join this ride")
+    _bump_ride_version(db, ride_id)
     return db_participation
+
+def create_ride_participation(db: Session, ride_id: int, user_id: int, details: RideParticipationCreate):
+    return _write(db, _add_ride_participation, ride_id, user_id, details)
+
+def get_ride_participation(db: Session, ride_id: int, participant_id: int):
+    return db.query(models.RideParticipation).filter(
+        models.RideParticipation.ride_id == ride_id,
+        models.RideParticipation.participant_id == participant_id
+    ).first()
+
+def _confirm_participation(db: Session, participation_id: int, version: int, ride_id: int, occupied_spaces: int):
+    # The participation is only confirmed if it has not changed since it was
+    # read. Seats are taken with a guarded increment instead of a version
+    # check: concurrent accepts on the same ride commute, so they need not
+    # conflict, but cannot reserve more seats than the ride allows.
+    claimed = db.execute(
+        update(models.RideParticipation)
+        .where(
+            models.RideParticipation.id == participation_id,
+            models.RideParticipation.status == "waiting",
+            _versioned(models.RideParticipation.version, version)
+        )
+        .values(status="confirmed", confirmation=datetime.utcnow(), version=models.RideParticipation.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        raise ConflictError("The participation request was modified by another request")
+    reserved = db.execute(
+        update(models.Ride)
+        .where(
+            models.Ride.id == ride_id,
+            models.Ride.confirmedSpaces + occupied_spaces <= models.Ride.allowedSpaces
+        )
+        .values(
+            confirmedSpaces=models.Ride.confirmedSpaces + occupied_spaces,
+            version=models.Ride.version + 1
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not reserved:
+        raise ValueError("Not enough spaces available")
+
+def confirm_ride_participation(db: Session, participation: models.RideParticipation):
+    _write(db, _confirm_participation, participation.id, participation.version,
+           participation.ride_id, participation.occupiedSpaces)
+    ride_index.reserve(participation.ride_id, participation.occupiedSpaces)
+
+def _waiting_participations(ride_id: int):
+    return exists().where(
+        models.RideParticipation.ride_id == ride_id,
+        models.RideParticipation.status == "waiting"
+    )
+
+def start_ride(db: Session, ride_id: int, version: int = None):
+    # The pending-request check is part of the UPDATE itself, so a request
+    # arriving between the check and the transition cannot be left waiting.
+    # With a version, the ride must also be unchanged since it was read.
+    started = db.execute(
+        update(models.Ride)
+        .where(models.Ride.id == ride_id, _versioned(models.Ride.version, version), ~_waiting_participations(ride_id))
+        .values(status="inprogress", version=models.Ride.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not started:
+        waiting = db.query(_waiting_participations(ride_id)).scalar()
+        db.rollback()
+        if waiting:
+            raise ValueError("There are pending participation requests")
+        raise ConflictError("The ride was modified by another request")
+    db.execute(
+        update(models.RideParticipation)
+        .where(models.RideParticipation.ride_id == ride_id)
+        .values(
+            status=case((models.RideParticipation.status == "confirmed", "inprogress"), else_="missing"),
+            version=models.RideParticipation.version + 1
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    ride_index.remove(ride_id)
+
+def end_ride(db: Session, ride_id: int, version: int = None):
+    ended = db.execute(
+        update(models.Ride)
+        .where(models.Ride.id == ride_id, _versioned(models.Ride.version, version))
+        .values(status="done", version=models.Ride.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not ended:
+        db.rollback()
+        raise ConflictError("The ride was modified by another request")
+    db.execute(
+        update(models.RideParticipation)
+        .where(models.RideParticipation.ride_id == ride_id, models.RideParticipation.status == "inprogress")
+        .values(status="notmarked", version=models.RideParticipation.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    ride_index.remove(ride_id)
+
+def _reject_participation(db: Session, participation_id: int, version: int, ride_id: int):
+    rejected = db.execute(
+        update(models.RideParticipation)
+        .where(
+            models.RideParticipation.id == participation_id,
+            models.RideParticipation.status == "waiting",
+            _versioned(models.RideParticipation.version, version)
+        )
+        .values(status="rejected", version=models.RideParticipation.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not rejected:
+        raise ConflictError("The participation request was modified by another request")
+    _bump_ride_version(db, ride_id)
+
+def reject_ride_participation(db: Session, participation: models.RideParticipation):
+    _write(db, _reject_participation, participation.id, participation.version, participation.ride_id)
+
+def unload_ride_participation(db: Session, participation: models.RideParticipation):
+    # An ORM change: version_id_col makes the flush check the version the
+    # participation was loaded with and raise StaleDataError if it changed.
+    try:
+        participation.status = "done"
+        _bump_ride_version(db, participation.ride_id)
+        db.commit()
+    except StaleDataError:
+        db.rollback()
+        raise ConflictError("The participation was modified by another request")
+    except Exception:
+        db.rollback()
+        raise
+
+def _ready_ride_rows(bind):
+    # Called from the index's reload thread, so it opens its own session.
+    columns = (models.Ride.id, models.Ride.rideDateAndTime, models.Ride.finalAddress,
+               models.Ride.freeSeats, models.Ride.driver_id)
+    with Session(bind=bind) as db:
+        return db.query(*columns).filter(models.Ride.status == "ready").all()
+
+def match_rides(db: Session, destination: str, at: datetime, seats: int = 1, k: int = 5, exclude_driver: int = None):
+    # Only reloads from the database when the in-memory index is stale.
+    ride_index.refresh(functools.partial(_ready_ride_rows, db.get_bind()))
+    return ride_index.match(destination, at, seats=seats, k=k, exclude_driver=exclude_driver)
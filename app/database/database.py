@@ -1,11 +1,140 @@
-from sqlalchemy import create_engine
+import logging
+import os
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
-from app.models.models import Base
+from app.database.migrations import run_migrations
+from app import metrics
+from app.slowlog import slow_query_log
 
-DATABASE_URL = "sqlite:///./test.db"
+logger = logging.getLogger(__name__)
 
-engine = create_engine(DATABASE_URL)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+
+# SQLite tuning applied to every new connection. WAL lets readers run while a
+# writer is active and busy_timeout makes writers wait for the lock instead of
+# failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-64000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "20"))
+READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", "40"))
+
+def _is_sqlite(url: str):
+    return url.startswith("sqlite")
+
+def _is_memory(url: str):
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+
+def read_only_url(url: str):
+    # Opens the same SQLite file through a "mode=ro" URI. Returns None when
+    # there is no file to share (other backends, in-memory databases).
+    if not _is_sqlite(url) or _is_memory(url):
+        return None
+    parsed = make_url(url)
+    return parsed.set(database=f"file:{parsed.database}", query={"mode": "ro", "uri": "true"}).render_as_string()
+
+def create_db_engine(url: str = DATABASE_URL, pragmas: dict = None,
+                     pool_size: int = POOL_SIZE, max_overflow: int = MAX_OVERFLOW, **kwargs):
+    if not _is_sqlite(url):
+        return create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                             pool_timeout=POOL_TIMEOUT, pool_pre_ping=True, **kwargs)
+
+    pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+    options = {"connect_args": {"check_same_thread": False}}
+    if _is_memory(url):
+        # In-memory databases live in a single connection; WAL does not apply.
+        pragmas.pop("journal_mode", None)
+    else:
+        options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=POOL_TIMEOUT)
+    options.update(kwargs)
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+def instrument_engine(engine):
+    # Statement count and time for the request running them (see app/metrics.py),
+    # plus the opt-in slow-query log (app/slowlog.py).
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _record_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        metrics.record_query(elapsed, statement)
+        if slow_query_log.is_slow(elapsed):
+            slow_query_log.record(cursor.connection, conn.dialect.name, statement, parameters, executemany, elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def _discard_timer(context):
+        # after_cursor_execute does not run for a failed statement.
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+    return engine
+
+def effective_pragmas(bind=None):
+    bind = bind or engine
+    if not _is_sqlite(str(bind.url)):
+        return {}
+    with bind.connect() as connection:
+        return {name: connection.exec_driver_sql(f"PRAGMA {name}").scalar() for name in SQLITE_PRAGMAS}
+
+def create_read_engine(url: str = DATABASE_URL):
+    ro_url = os.getenv("READ_DATABASE_URL") or read_only_url(url)
+    if ro_url is None:
+        return None
+    # The journal mode is owned by the writer; a read-only connection cannot change it.
+    pragmas = {name: value for name, value in SQLITE_PRAGMAS.items() if name != "journal_mode"}
+    pragmas["query_only"] = "ON"
+    return create_db_engine(ro_url, pragmas=pragmas, pool_size=READ_POOL_SIZE, max_overflow=READ_MAX_OVERFLOW)
+
+engine = instrument_engine(create_db_engine())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# GET routes use their own pool of read-only connections so that, with WAL,
+# reads run concurrently with the writer instead of queuing behind it.
+read_engine = create_read_engine()
+read_engine = instrument_engine(read_engine) if read_engine is not None else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+def create_writer_sessionmaker(url: str = DATABASE_URL):
+    # A single connection for the group-commit writer (app/group_commit.py).
+    # Its batches nest one SAVEPOINT per request, which needs the driver's own
+    # transaction handling turned off: with it, the first SAVEPOINT would open
+    # the transaction and releasing it would commit. BEGIN IMMEDIATE takes
+    # the write lock up front instead of upgrading mid-batch.
+    writer_engine = instrument_engine(create_db_engine(url, pool_size=1, max_overflow=0))
+    if _is_sqlite(url):
+        @event.listens_for(writer_engine, "connect")
+        def _disable_driver_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(writer_engine, "begin")
+        def _begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+    # Results are handed to other threads after the commit, so they must not
+    # expire (and lazy-load through this session) when it commits.
+    return sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=writer_engine)
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    logger.info("Database %s ready with pragmas %s", engine.url.render_as_string(hide_password=True), effective_pragmas())
@@ -0,0 +1,130 @@
+import logging
+from sqlalchemy.schema import CreateIndex
+from app.models.models import Base, RIDES_FTS_DDL, RIDES_FTS_REBUILD
+
+logger = logging.getLogger(__name__)
+
+# create_all only creates missing tables, so columns and indexes added to
+# existing tables are applied here. The schema version is kept in SQLite's
+# PRAGMA user_version and every step is idempotent, so a step that finds its
+# change already in place (e.g. on a database just built by create_all)
+# only records the new version. Data fix-ups run unconditionally within
+# their step rather than only when the step added a column.
+#
+# Several workers may start at once, so run_migrations holds SQLite's write
+# lock (BEGIN IMMEDIATE) from reading user_version to the last step. The
+# driver's own transaction handling is turned off for this: it would run
+# the DDL outside the transaction.
+
+def _columns(connection, table: str):
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+def _add_column(connection, table: str, column: str, ddl: str):
+    if column not in _columns(connection, table):
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        return True
+    return False
+
+def _create_indexes(connection, table: str):
+    for index in Base.metadata.tables[table].indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+def _ride_counters(connection):
+    _add_column(connection, "rides", "confirmedSpaces", "INTEGER DEFAULT 0")
+    connection.exec_driver_sql(
+        "UPDATE rides SET confirmedSpaces = ("
+        "SELECT COALESCE(SUM(occupiedSpaces), 0) FROM ride_participations "
+        "WHERE ride_participations.ride_id = rides.id AND ride_participations.status = 'confirmed')"
+    )
+    _add_column(connection, "rides", "version", "INTEGER DEFAULT 1")
+
+def _participation_rank(status: str):
+    # Which duplicate request to keep: one the driver accepted (confirmed or
+    # later), then one still waiting, then a rejected one.
+    return {"waiting": 1, "rejected": 2}.get(status, 0)
+
+def _remove_duplicate_participations(connection):
+    # Before the UNIQUE(ride_id, participant_id) index, duplicates were only
+    # prevented by a check in Python that concurrent requests could race
+    # past; the index cannot be built until they are gone.
+    rows = connection.exec_driver_sql(
+        "SELECT id, ride_id, participant_id, status FROM ride_participations "
+        "WHERE (ride_id, participant_id) IN ("
+        "SELECT ride_id, participant_id FROM ride_participations "
+        "WHERE ride_id IS NOT NULL AND participant_id IS NOT NULL "
+        "GROUP BY ride_id, participant_id HAVING COUNT(*) > 1) "
+        "ORDER BY id"
+    ).all()
+    groups = {}
+    for row in rows:
+        groups.setdefault((row.ride_id, row.participant_id), []).append(row)
+    removed = []
+    for (ride_id, participant_id), group in groups.items():
+        # Ties keep the oldest request.
+        keep = min(group, key=lambda row: (_participation_rank(row.status), row.id))
+        duplicates = [row.id for row in group if row.id != keep.id]
+        logger.warning("Removing duplicate participation requests %s of participant %s in ride %s (keeping %s)",
+                       duplicates, participant_id, ride_id, keep.id)
+        removed.extend(duplicates)
+    if not removed:
+        return
+    connection.exec_driver_sql(
+        f"DELETE FROM ride_participations WHERE id IN ({', '.join('?' * len(removed))})", tuple(removed)
+    )
+    # A removed duplicate may have been counted as a confirmed seat.
+    ride_ids = sorted({ride_id for ride_id, _ in groups})
+    connection.exec_driver_sql(
+        "UPDATE rides SET confirmedSpaces = ("
+        "SELECT COALESCE(SUM(occupiedSpaces), 0) FROM ride_participations "
+        "WHERE ride_participations.ride_id = rides.id AND ride_participations.status = 'confirmed') "
+        f"WHERE id IN ({', '.join('?' * len(ride_ids))})", tuple(ride_ids)
+    )
+
+def _ride_indexes(connection):
+    _remove_duplicate_participations(connection)
+    _create_indexes(connection, "rides")
+    _create_indexes(connection, "ride_participations")
+
+def _rides_search(connection):
+    for statement in RIDES_FTS_DDL + RIDES_FTS_REBUILD:
+        connection.exec_driver_sql(statement)
+
+def _history_indexes(connection):
+    # ix_rides_driver_date supersedes the single-column driver index.
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_rides_driver_id")
+    _create_indexes(connection, "rides")
+    _create_indexes(connection, "ride_participations")
+
+def _participation_versions(connection):
+    _add_column(connection, "ride_participations", "version", "INTEGER NOT NULL DEFAULT 1")
+
+MIGRATIONS = [
+    (1, _ride_counters),
+    (2, _ride_indexes),
+    (3, _rides_search),
+    (4, _history_indexes),
+    (5, _participation_versions),
+]
+
+def schema_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+def run_migrations(engine):
+    """Creates missing tables and applies pending migrations; returns the schema version."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            # Another worker may have migrated while this one waited for the lock.
+            current = schema_version(connection)
+            Base.metadata.create_all(bind=connection)
+            for version, step in MIGRATIONS:
+                if version > current:
+                    logger.info("Applying schema migration %s (%s)", version, step.__name__)
+                    step(connection)
+                    connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+            version = schema_version(connection)
+            connection.exec_driver_sql("COMMIT")
+        except Exception:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        return version
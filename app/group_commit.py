@@ -0,0 +1,120 @@
+"""Group commit for high-rate writes.
+
+SQLite has a single writer, so under load every request's commit queues for
+the write lock and pays its own sync. With GROUP_COMMIT_WINDOW_MS set, write
+jobs are handed to one writer thread that collects the jobs arriving within
+the window (up to GROUP_COMMIT_MAX_BATCH) and runs them in one transaction,
+each inside its own SAVEPOINT. A job that raises only rolls back its
+savepoint and its caller gets the exception; the others commit together.
+If the final COMMIT fails, every job in the batch gets the error.
+
+A job is a function ``job(db, *args)`` that writes through the session
+without committing. Its result is returned to the caller after the commit,
+detached from the writer's session, so it must load whatever the caller
+will read. Each job runs in a copy of its caller's context, so its SQL is
+counted in that request's SQL metrics and profile report (the
+savepoints and the shared COMMIT are not attributed to any request).
+"""
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import metrics
+
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "0"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+class GroupCommitter:
+    def __init__(self, session_factory, window_ms: float = GROUP_COMMIT_WINDOW_MS,
+                 max_batch: int = GROUP_COMMIT_MAX_BATCH, registry: metrics.Metrics = metrics.registry):
+        # session_factory is called from the writer thread to build the
+        # writer's sessionmaker, so nothing is opened until the first job.
+        self.session_factory = session_factory
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.registry = registry
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        registry.register("group_commit_batch_size", "Write jobs committed per group commit.", BATCH_SIZE_BUCKETS)
+        registry.register("group_commit_wait_seconds",
+                          "Time from submitting a write job to its group commit finishing, in seconds.", WAIT_BUCKETS)
+
+    @property
+    def enabled(self):
+        return self.window_ms > 0
+
+    def submit(self, job, *args):
+        """Runs job(db, *args) in the next group commit and returns its result or raises its exception."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((job, args, future, time.perf_counter(), contextvars.copy_context()))
+        return future.result()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        sessionmaker = None
+        while True:
+            batch = self._collect()
+            try:
+                sessionmaker = sessionmaker or self.session_factory()
+                outcomes = self._commit(sessionmaker, batch)
+            except Exception as exc:
+                # The transaction did not commit: no job in the batch took effect.
+                outcomes = [(future, None, exc) for _, _, future, *_ in batch]
+            finished = time.perf_counter()
+            self.registry.observe_series("group_commit_batch_size", len(batch))
+            self.registry.observe_series("group_commit_wait_seconds", *(finished - submitted for *_, submitted, _ in batch))
+            for future, result, exc in outcomes:
+                if exc is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exc)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window_ms / 1000
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, sessionmaker, batch):
+        db = sessionmaker()
+        try:
+            outcomes = []
+            for job, args, future, _, context in batch:
+                savepoint = db.begin_nested()
+                # Emits BEGIN/SAVEPOINT here rather than in the job's context.
+                db.connection()
+                try:
+                    result = context.run(job, db, *args)
+                    savepoint.commit()
+                    outcomes.append((future, result, None))
+                except Exception as exc:
+                    savepoint.rollback()
+                    outcomes.append((future, None, exc))
+            db.commit()
+            return outcomes
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
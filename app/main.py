@@ -1,10 +1,35 @@
+import logging
+import os
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from .database import database
-from .routers import users, rides
+from .metrics import MetricsMiddleware, registry
+from .profiling import ProfilerMiddleware
+from .routers import users, rides, export, debug
+
+# uvicorn only configures its own loggers, so the app's (startup pragmas,
+# schema migrations, slow queries) would be dropped at the root logger's
+# default WARNING level. They get their own handler unless logging was
+# already set up by whoever runs the app.
+app_logger = logging.getLogger("app")
+app_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+if not logging.getLogger().handlers and not app_logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:     %(name)s - %(message)s"))
+    app_logger.addHandler(handler)
 
 app = FastAPI()
+# Added last, so MetricsMiddleware wraps the profiler and tracks the request's SQL for it.
+app.add_middleware(ProfilerMiddleware, is_admin=debug.is_admin)
+app.add_middleware(MetricsMiddleware)
 
 database.init_db()
 
 app.include_router(users.router)
 app.include_router(rides.router)
+app.include_router(export.router)
+app.include_router(debug.router)
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
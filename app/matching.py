@@ -0,0 +1,194 @@
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# Words that appear in most Lima addresses and say nothing about the place.
+STOPWORDS = {"av", "avenida", "jr", "jiron", "calle", "ca", "psje", "pasaje", "de", "del", "la", "el", "los", "las", "y"}
+
+RideCandidate = namedtuple("RideCandidate", ["id", "rideDateAndTime", "finalAddress", "freeSeats", "score"])
+
+def address_tokens(address: str):
+    normalized = unicodedata.normalize("NFKD", address or "").encode("ascii", "ignore").decode().lower()
+    return frozenset(t for t in re.findall(r"[a-z]+", normalized) if len(t) > 1 and t not in STOPWORDS)
+
+class _Entry:
+    __slots__ = ("id", "departure", "finalAddress", "tokens", "free_seats", "driver_id")
+
+    def __init__(self, ride_id, departure, final_address, free_seats, driver_id):
+        self.id = ride_id
+        self.departure = departure
+        self.finalAddress = final_address
+        self.tokens = address_tokens(final_address)
+        self.free_seats = free_seats
+        self.driver_id = driver_id
+
+class RideIndex:
+    """In-memory index of ready rides for matching participants to rides.
+
+    Rides are kept ordered by departure time together with an inverted index
+    from address tokens to ride ids. The crud layer applies every change made
+    by this process incrementally; changes made by other workers are picked
+    up when the index is reloaded after max_age seconds.
+
+    A reload builds a new index outside the lock and swaps it in. Only one
+    caller reloads at a time: the first load blocks the requests that need
+    it, later ones run in a background thread while the old index keeps
+    answering.
+    """
+
+    def __init__(self, max_age: float = 30.0):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded = threading.Condition(self._lock)
+        self._generation = 0
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._by_time = []
+            self._postings = {}
+            self._loaded_at = None
+            # Changes applied while a reload runs, replayed on its result.
+            self._pending = None
+            # A reload started before clear() is discarded.
+            self._generation += 1
+            self._loaded.notify_all()
+
+    def is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    @staticmethod
+    def _build(rides):
+        # rides: iterable of (id, rideDateAndTime, finalAddress, freeSeats, driver_id)
+        entries = {ride[0]: _Entry(*ride) for ride in rides}
+        by_time = sorted((entry.departure, entry.id) for entry in entries.values())
+        postings = {}
+        for entry in entries.values():
+            for token in entry.tokens:
+                postings.setdefault(token, set()).add(entry.id)
+        return entries, by_time, postings
+
+    def refresh(self, fetch):
+        """Reloads the index with the rides fetch() returns if it is stale and no reload is running."""
+        with self._lock:
+            while self._pending is not None and self._loaded_at is None:
+                self._loaded.wait()
+            if self._pending is not None or not self.is_stale():
+                return
+            self._pending = []
+            generation = self._generation
+            background = self._loaded_at is not None
+        if background:
+            threading.Thread(target=self._reload, args=(fetch, generation), name="ride-index-refresh",
+                             daemon=True).start()
+        else:
+            self._reload(fetch, generation)
+
+    def _reload(self, fetch, generation):
+        try:
+            built = self._build(fetch())
+        except Exception:
+            with self._lock:
+                if generation == self._generation:
+                    self._pending = None
+                    self._loaded.notify_all()
+            if self._loaded_at is None:
+                raise
+            logger.exception("Ride index reload failed; serving the previous index")
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            pending = self._pending
+            self._entries, self._by_time, self._postings = built
+            # A change may also be in the reloaded rows: add and remove are
+            # idempotent, and a replayed reservation at worst hides seats
+            # until the next reload.
+            for apply, args in pending:
+                apply(*args)
+            self._loaded_at = time.monotonic()
+            self._pending = None
+            self._loaded.notify_all()
+
+    def _record(self, apply, *args):
+        if self._pending is not None:
+            self._pending.append((apply, args))
+        if self._loaded_at is not None:
+            apply(*args)
+
+    def add(self, ride_id, departure, final_address, free_seats, driver_id):
+        with self._lock:
+            self._record(self._add, ride_id, departure, final_address, free_seats, driver_id)
+
+    def reserve(self, ride_id, seats):
+        with self._lock:
+            self._record(self._reserve, ride_id, seats)
+
+    def remove(self, ride_id):
+        with self._lock:
+            self._record(self._remove, ride_id)
+
+    def _add(self, ride_id, departure, final_address, free_seats, driver_id):
+        if ride_id not in self._entries:
+            self._insert(_Entry(ride_id, departure, final_address, free_seats, driver_id))
+
+    def _reserve(self, ride_id, seats):
+        entry = self._entries.get(ride_id)
+        if entry is not None:
+            entry.free_seats -= seats
+
+    def _remove(self, ride_id):
+        entry = self._entries.pop(ride_id, None)
+        if entry is None:
+            return
+        position = bisect.bisect_left(self._by_time, (entry.departure, entry.id))
+        del self._by_time[position]
+        for token in entry.tokens:
+            ids = self._postings[token]
+            ids.discard(ride_id)
+            if not ids:
+                del self._postings[token]
+
+    def _insert(self, entry):
+        self._entries[entry.id] = entry
+        bisect.insort(self._by_time, (entry.departure, entry.id))
+        for token in entry.tokens:
+            self._postings.setdefault(token, set()).add(entry.id)
+
+    def match(self, destination: str, at: datetime, seats: int = 1, k: int = 5,
+              window: timedelta = timedelta(hours=2), exclude_driver: int = None):
+        # Score = share of the destination's tokens found in the ride's final
+        # address, minus up to 0.5 for the distance to the requested time.
+        tokens = address_tokens(destination)
+        if not tokens:
+            return []
+        if at.tzinfo is not None:
+            # Departures are stored naive, in UTC.
+            at = at.astimezone(timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            low = bisect.bisect_left(self._by_time, (at - window,))
+            high = bisect.bisect_right(self._by_time, (at + window, float("inf")))
+            by_token = set().union(*(self._postings.get(token, ()) for token in tokens))
+            if len(by_token) < high - low:
+                candidates = [self._entries[ride_id] for ride_id in by_token]
+            else:
+                candidates = [self._entries[ride_id] for _, ride_id in self._by_time[low:high]]
+            scored = []
+            for entry in candidates:
+                delta = abs((entry.departure - at).total_seconds())
+                if delta > window.total_seconds() or entry.free_seats < seats or entry.driver_id == exclude_driver:
+                    continue
+                overlap = len(tokens & entry.tokens) / len(tokens)
+                if overlap:
+                    score = overlap - 0.5 * delta / window.total_seconds()
+                    scored.append(RideCandidate(entry.id, entry.departure, entry.finalAddress, entry.free_seats, round(score, 4)))
+        return heapq.nlargest(k, scored, key=lambda c: (c.score, -c.id))
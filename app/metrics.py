@@ -0,0 +1,179 @@
+"""In-process request metrics rendered in the Prometheus text format.
+
+MetricsMiddleware times every request and labels it with the route template
+(e.g. /usuarios/{alias}/rides) so paths with ids do not create new series.
+SQL statements are attributed to the request running them through a context
+variable that the engine events in app/database/database.py update.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def route_label(scope):
+    # The router stores the matched route in the scope; unmatched paths
+    # share one label to keep the number of series bounded.
+    return getattr(scope.get("route"), "path", "unmatched")
+
+class RequestStats:
+    __slots__ = ("scope", "queries", "db_time", "statements")
+
+    def __init__(self, scope=None):
+        self.scope = scope
+        self.queries = 0
+        self.db_time = 0.0
+        # Set to a list by the profiler to keep (statement, seconds) pairs.
+        self.statements = None
+
+    @property
+    def route(self):
+        return f"{self.scope['method']} {route_label(self.scope)}" if self.scope else None
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+def record_query(seconds: float, statement: str = None):
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += seconds
+        if stats.statements is not None:
+            stats.statements.append((statement, seconds))
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        other = Histogram(self.buckets)
+        other.counts, other.sum, other.count = list(self.counts), self.sum, self.count
+        return other
+
+    def lines(self, name: str, labels: str = ""):
+        cumulative = 0
+        prefix = f"{labels}," if labels else ""
+        suffix = f"{{{labels}}}" if labels else ""
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{suffix} {self.sum}"
+        yield f"{name}_count{suffix} {self.count}"
+
+HISTOGRAMS = [
+    ("http_request_duration_seconds", "Request latency in seconds.", LATENCY_BUCKETS),
+    ("http_request_sql_queries", "SQL statements executed per request.", QUERY_BUCKETS),
+    ("http_request_db_duration_seconds", "Time spent in SQL statements per request, in seconds.", LATENCY_BUCKETS),
+]
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Unlabelled histograms registered by other components, by name.
+        self.series = {}
+        # Callables returning (name, type, description, value) samples that
+        # other components compute when the metrics are rendered.
+        self.collectors = []
+        self.clear()
+
+    def clear(self):
+        self.requests = {}
+        self.histograms = {}
+        self.series = {name: (description, Histogram(histogram.buckets))
+                       for name, (description, histogram) in self.series.items()}
+
+    def register(self, name: str, description: str, buckets):
+        with self._lock:
+            self.series.setdefault(name, (description, Histogram(buckets)))
+
+    def register_collector(self, collect):
+        with self._lock:
+            self.collectors.append(collect)
+
+    def observe_series(self, name: str, *values: float):
+        with self._lock:
+            histogram = self.series[name][1]
+            for value in values:
+                histogram.observe(value)
+
+    def observe(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = self.histograms[key] = [Histogram(buckets) for _, _, buckets in HISTOGRAMS]
+            histograms[0].observe(seconds)
+            histograms[1].observe(stats.queries)
+            histograms[2].observe(stats.db_time)
+
+    def render(self):
+        with self._lock:
+            requests = dict(self.requests)
+            histograms = {key: [h.copy() for h in values] for key, values in self.histograms.items()}
+            series = {name: (description, histogram.copy()) for name, (description, histogram) in self.series.items()}
+            collectors = list(self.collectors)
+        lines = ["# HELP http_requests_total Requests handled, by route and status code.",
+                 "# TYPE http_requests_total counter"]
+        for (method, route, status), count in sorted(requests.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {count}')
+        for index, (name, description, _) in enumerate(HISTOGRAMS):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route), values in sorted(histograms.items()):
+                lines.extend(values[index].lines(name, f'method="{method}",route="{_escape(route)}"'))
+        for name, (description, histogram) in sorted(series.items()):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            lines.extend(histogram.lines(name))
+        for collect in collectors:
+            for name, kind, description, value in collect():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+registry = Metrics()
+
+class MetricsMiddleware:
+    """ASGI middleware; unlike BaseHTTPMiddleware it also times streamed bodies to the last chunk."""
+
+    def __init__(self, app, metrics: Metrics = registry):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            self.metrics.observe(scope["method"], route_label(scope), status, time.perf_counter() - start, stats)
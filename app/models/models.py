@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Index, DDL, event
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 
 Base = declarative_base()
 
@@ -14,17 +15,37 @@ class User(Base):
 
 class Ride(Base):
     __tablename__ = 'rides'
+    __table_args__ = (
+        Index('ix_rides_status_date_id', 'status', 'rideDateAndTime', 'id'),
+        Index('ix_rides_driver_date', 'driver_id', 'rideDateAndTime'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     rideDateAndTime = Column(DateTime)
     finalAddress = Column(String)
     allowedSpaces = Column(Integer)
+    confirmedSpaces = Column(Integer, default=0)
     driver_id = Column(Integer, ForeignKey('users.id'))
     status = Column(String, default="ready")
+    # Bumped on every change to the ride or its participations; used for ETags
+    # and, as the mapper's version_id_col, to reject ORM updates of a ride
+    # that changed since it was loaded.
+    version = Column(Integer, default=1, nullable=False)
     rideDriver = relationship("User", back_populates="rides")
     participants = relationship("RideParticipation", back_populates="ride")
 
+    __mapper_args__ = {"version_id_col": version}
+
+    @hybrid_property
+    def freeSeats(self):
+        return self.allowedSpaces - self.confirmedSpaces
+
 class RideParticipation(Base):
     __tablename__ = 'ride_participations'
+    __table_args__ = (
+        Index('ix_ride_participations_ride_status', 'ride_id', 'status'),
+        Index('ix_ride_participations_participant_status', 'participant_id', 'status'),
+        Index('uq_ride_participations_ride_participant', 'ride_id', 'participant_id', unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     confirmation = Column(DateTime, nullable=True)
     destination = Column(String)
@@ -32,5 +53,41 @@ class RideParticipation(Base):
     status = Column(String, default="waiting")
     ride_id = Column(Integer, ForeignKey('rides.id'))
     participant_id = Column(Integer, ForeignKey('users.id'))
+    version = Column(Integer, default=1, nullable=False)
     ride = relationship("Ride", back_populates="participants")
     participant = relationship("User")
+
+    __mapper_args__ = {"version_id_col": version}
+
+# Full-text index over ride addresses and participation destinations. rowid
+# is the ride id; the triggers keep it in sync with both tables.
+RIDES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS rides_fts USING fts5("
+    "finalAddress, destinations, tokenize = 'unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS rides_fts_ai AFTER INSERT ON rides BEGIN "
+    "INSERT INTO rides_fts(rowid, finalAddress, destinations) VALUES (NEW.id, NEW.finalAddress, ''); END",
+    "CREATE TRIGGER IF NOT EXISTS rides_fts_au AFTER UPDATE OF finalAddress ON rides BEGIN "
+    "UPDATE rides_fts SET finalAddress = NEW.finalAddress WHERE rowid = NEW.id; END",
+    "CREATE TRIGGER IF NOT EXISTS rides_fts_ad AFTER DELETE ON rides BEGIN "
+    "DELETE FROM rides_fts WHERE rowid = OLD.id; END",
+    "CREATE TRIGGER IF NOT EXISTS ride_participations_fts_ai AFTER INSERT ON ride_participations BEGIN "
+    "UPDATE rides_fts SET destinations = (SELECT group_concat(destination, ' ') FROM ride_participations "
+    "WHERE ride_id = NEW.ride_id) WHERE rowid = NEW.ride_id; END",
+    "CREATE TRIGGER IF NOT EXISTS ride_participations_fts_au AFTER UPDATE OF destination, ride_id ON ride_participations BEGIN "
+    "UPDATE rides_fts SET destinations = (SELECT group_concat(destination, ' ') FROM ride_participations "
+    "WHERE ride_id = rides_fts.rowid) WHERE rowid IN (OLD.ride_id, NEW.ride_id); END",
+    "CREATE TRIGGER IF NOT EXISTS ride_participations_fts_ad AFTER DELETE ON ride_participations BEGIN "
+    "UPDATE rides_fts SET destinations = (SELECT group_concat(destination, ' ') FROM ride_participations "
+    "WHERE ride_id = OLD.ride_id) WHERE rowid = OLD.ride_id; END",
+]
+
+RIDES_FTS_REBUILD = [
+    "DELETE FROM rides_fts",
+    "INSERT INTO rides_fts(rowid, finalAddress, destinations) "
+    "SELECT id, finalAddress, (SELECT group_concat(destination, ' ') FROM ride_participations "
+    "WHERE ride_id = rides.id) FROM rides",
+]
+
+for statement in RIDES_FTS_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Base.metadata, "before_drop", DDL("DROP TABLE IF EXISTS rides_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,176 @@
+"""Opt-in cProfile reports for individual requests.
+
+A request is profiled when an admin sends "X-Profile: 1" (with its
+X-Admin-Token) or when it is picked by PROFILE_SAMPLE_RATE. The report, with
+the top PROFILE_TOP_N functions by cumulative time and the SQL statements the
+request ran, is kept in a bounded in-memory store; its id is returned in the
+X-Profile-Id header and the report is served at /debug/profiles/{id}.
+
+cProfile only follows the thread that enables it and FastAPI runs sync
+endpoints in a worker thread, so routers use ProfiledRoute, which enables the
+request's profiler around the endpoint call in whichever thread runs it.
+"""
+import cProfile
+import functools
+import inspect
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.routing import APIRoute
+
+from . import metrics
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+PROFILE_STORE_SIZE = int(os.getenv("PROFILE_STORE_SIZE", "50"))
+# Sampling skips the endpoints that read the collected data.
+UNSAMPLED_PREFIXES = ("/debug", "/metrics")
+
+current_profiler: ContextVar[Optional[cProfile.Profile]] = ContextVar("current_profiler", default=None)
+
+def profiled(call):
+    if getattr(call, "__profiled__", False):
+        return call
+    if inspect.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def wrapper(*args, **kwargs):
+            profiler = current_profiler.get()
+            if profiler is None:
+                return await call(*args, **kwargs)
+            profiler.enable()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                profiler.disable()
+    else:
+        @functools.wraps(call)
+        def wrapper(*args, **kwargs):
+            profiler = current_profiler.get()
+            if profiler is None:
+                return call(*args, **kwargs)
+            profiler.enable()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                profiler.disable()
+    wrapper.__profiled__ = True
+    return wrapper
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+def top_functions(profiler: cProfile.Profile, limit: int):
+    profiler.create_stats()
+    if not profiler.stats:
+        # No endpoint ran under the profiler (e.g. the path matched no route).
+        return []
+    stats = pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE)
+    rows = []
+    for function in stats.fcn_list[:limit]:
+        primitive_calls, calls, total, cumulative, _ = stats.stats[function]
+        filename, line, name = function
+        rows.append({
+            "function": f"{filename}:{line}({name})" if line else name,
+            "calls": calls if calls == primitive_calls else f"{calls}/{primitive_calls}",
+            "tottime_ms": round(total * 1000, 3),
+            "cumtime_ms": round(cumulative * 1000, 3),
+        })
+    return rows
+
+class ProfileStore:
+    def __init__(self, maxsize: int = PROFILE_STORE_SIZE):
+        self.maxsize = maxsize
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, report: dict):
+        with self._lock:
+            self._reports[report["id"]] = report
+            while len(self._reports) > self.maxsize:
+                self._reports.popitem(last=False)
+
+    def get(self, report_id: str):
+        with self._lock:
+            return self._reports.get(report_id)
+
+    def summaries(self):
+        with self._lock:
+            reports = list(reversed(self._reports.values()))
+        return [{key: report[key] for key in ("id", "at", "method", "route", "path", "status", "duration_ms", "trigger")}
+                | {"sql_count": report["sql"]["count"]} for report in reports]
+
+    def clear(self):
+        with self._lock:
+            self._reports.clear()
+
+profile_store = ProfileStore()
+
+class ProfilerMiddleware:
+    """ASGI middleware; runs inside MetricsMiddleware, which tracks the request's SQL."""
+
+    def __init__(self, app, store: ProfileStore = profile_store, is_admin=None):
+        self.app = app
+        self.store = store
+        self.is_admin = is_admin
+
+    def _trigger(self, scope):
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile") == b"1" and self.is_admin is not None:
+            token = headers.get(b"x-admin-token")
+            if self.is_admin(token.decode("latin-1") if token is not None else None):
+                return "header"
+        if PROFILE_SAMPLE_RATE and not scope["path"].startswith(UNSAMPLED_PREFIXES) \
+                and random.random() < PROFILE_SAMPLE_RATE:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        trigger = self._trigger(scope) if scope["type"] == "http" else None
+        if trigger is None:
+            return await self.app(scope, receive, send)
+        report_id = uuid.uuid4().hex[:16]
+        profiler = cProfile.Profile()
+        token = current_profiler.set(profiler)
+        stats = metrics.current_request.get()
+        if stats is not None:
+            stats.statements = []
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", report_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profiler.reset(token)
+            statements = stats.statements if stats is not None else []
+            self.store.add({
+                "id": report_id,
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "method": scope["method"],
+                "route": metrics.route_label(scope),
+                "path": scope["path"],
+                "status": status,
+                "trigger": trigger,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                "sql": {
+                    "count": len(statements),
+                    "total_ms": round(sum(seconds for _, seconds in statements) * 1000, 3),
+                    "statements": [{"statement": statement, "duration_ms": round(seconds * 1000, 3)}
+                                   for statement, seconds in statements],
+                },
+                "functions": top_functions(profiler, PROFILE_TOP_N),
+            })
@@ -0,0 +1,39 @@
+import hmac
+import os
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from ..profiling import profile_store
+from ..slowlog import slow_query_log
+
+# Debug endpoints expose SQL and parameters; they only exist when an admin
+# token is configured and every request must present it.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def is_admin(token: Optional[str]):
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+router = APIRouter(prefix="/debug", dependencies=[Depends(require_admin)], include_in_schema=False)
+
+@router.get("/slow-queries")
+def read_slow_queries(limit: int = Query(100, ge=1), full_scans_only: bool = False):
+    records = slow_query_log.records()
+    if full_scans_only:
+        records = [record for record in records if record["full_scans"]]
+    return {"enabled": slow_query_log.enabled, "threshold_ms": slow_query_log.threshold_ms, "records": records[:limit]}
+
+@router.get("/profiles")
+def read_profiles():
+    return profile_store.summaries()
+
+@router.get("/profiles/{report_id}")
+def read_profile(report_id: str):
+    report = profile_store.get(report_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
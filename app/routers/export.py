@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import datetime
+from .. import crud
+from ..schemas import schemas
+from ..database.database import ReadSessionLocal
+from ..profiling import ProfiledRoute
+
+router = APIRouter(route_class=ProfiledRoute)
+
+def _ride_lines(status: Optional[str], date_from: Optional[datetime], date_to: Optional[datetime]):
+    # The session belongs to the generator: it has to outlive the route
+    # function and stay open while the body is being streamed.
+    db = ReadSessionLocal()
+    try:
+        for batch in crud.iter_ride_batches(db, status=status, date_from=date_from, date_to=date_to):
+            yield "".join(schemas.Ride.model_validate(ride, from_attributes=True).model_dump_json() + "\n" for ride in batch)
+    finally:
+        db.close()
+
+@router.get("/export/rides.ndjson")
+def export_rides(status: Optional[str] = None,
+                 date_from: Optional[datetime] = Query(None, alias="from"),
+                 date_to: Optional[datetime] = Query(None, alias="to")):
+    return StreamingResponse(_ride_lines(status, date_from, date_to), media_type="application/x-ndjson")
@@ -1,13 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Literal, Optional
+from datetime import datetime
 from .. import crud
 from ..models import models
 from ..schemas import schemas
-from ..database.database import SessionLocal
-from datetime import datetime
+from ..schemas.serializers import json_response, projection_response, ride_adapter, ride_list_adapter
+from ..database.database import SessionLocal, ReadSessionLocal
+from ..etag import etag_matches, weak_etag
+from ..profiling import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 def get_db():
     db = SessionLocal()
@@ -16,174 +19,263 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def _conflict(error: crud.ConflictError):
+    # Another request changed the ride or participation first. Retrying
+    # re-reads the current state, so clients may retry right away.
+    return HTTPException(
+        status_code=409,
+        detail={"code": "write_conflict", "message": str(error), "retryable": True},
+        headers={"Retry-After": "0"}
+    )
+
+def _summary_fields(view: str, fields: Optional[str]):
+    # None means the full schemas.Ride payload.
+    if fields:
+        requested = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in requested if field not in crud.RIDE_SUMMARY_COLUMNS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        return requested
+    if view == "summary":
+        return list(crud.RIDE_SUMMARY_COLUMNS)
+    return None
+
+def _ride_list_response(db: Session, keys, limit: int, etag_scope: tuple,
+                        summary: Optional[List[str]], if_none_match: Optional[str]):
+    headers = {"ETag": weak_etag(*etag_scope, summary, [(key.id, key.version) for key in keys])}
+    if keys and len(keys) == limit:
+        headers["X-Next-Cursor"] = crud.ride_cursor(keys[-1])
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if summary:
+        return projection_response(keys, summary, headers=headers)
+    return json_response(ride_list_adapter, crud.get_rides_by_ids(db, [key.id for key in keys]), headers=headers)
+
 @router.post("/usuarios/{alias}/rides", response_model=schemas.Ride)
 def create_ride_for_user(alias: str, ride: schemas.RideCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_alias(db, alias=alias)
+    db_user = crud.resolve_alias(db, alias=alias)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
     if not db_user.carPlate:
         raise HTTPException(status_code=422, detail="User is not a driver")
-    return crud.create_ride(db=db, ride=ride, driver_id=db_user.id)
+    return json_response(ride_adapter, crud.create_ride(db=db, ride=ride, driver_id=db_user.id))
 
 @router.get("/rides", response_model=List[schemas.Ride])
-def read_rides(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    rides = crud.get_rides(db, skip=skip, limit=limit)
-    return rides
+def read_rides(skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+               date_from: Optional[datetime] = Query(None, alias="from"),
+               date_to: Optional[datetime] = Query(None, alias="to"),
+               min_free_seats: Optional[int] = Query(None, alias="minFreeSeats"),
+               sort: Literal["date", "-date"] = "date",
+               view: Literal["full", "summary"] = "full", fields: Optional[str] = None,
+               if_none_match: Optional[str] = Header(None), db: Session = Depends(get_read_db)):
+    summary = _summary_fields(view, fields)
+    try:
+        keys = crud.get_ride_versions(db, skip=skip, limit=limit, cursor=cursor, fields=summary or (),
+                                      date_from=date_from, date_to=date_to, min_free_seats=min_free_seats, sort=sort)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return _ride_list_response(db, keys, limit, ("rides",), summary, if_none_match)
+
+@router.get("/rides/search", response_model=List[schemas.Ride])
+def search_rides(q: str = Query(..., min_length=1), skip: int = 0, limit: int = 20, db: Session = Depends(get_read_db)):
+    return json_response(ride_list_adapter, crud.search_rides(db, q=q, skip=skip, limit=limit))
 
 @router.get("/usuarios/{alias}/rides", response_model=List[schemas.Ride])
-def read_user_rides(alias: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_alias(db, alias=alias)
+def read_user_rides(alias: str, limit: int = 100, cursor: Optional[str] = None,
+                    status: Optional[str] = None, view: Literal["full", "summary"] = "full",
+                    fields: Optional[str] = None, if_none_match: Optional[str] = Header(None),
+                    db: Session = Depends(get_read_db)):
+    db_user = crud.resolve_alias(db, alias=alias)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    summary = _summary_fields(view, fields)
+    try:
+        keys = crud.get_ride_versions_by_driver(db, driver_id=db_user.id, limit=limit, cursor=cursor,
+                                                status=status, fields=summary or ())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return _ride_list_response(db, keys, limit, ("user_rides", db_user.id), summary, if_none_match)
+
+@router.get("/usuarios/{alias}/participations", response_model=List[schemas.UserParticipation])
+def read_user_participations(alias: str, response: Response, limit: int = 100, cursor: Optional[str] = None,
+                             status: Optional[str] = None, db: Session = Depends(get_read_db)):
+    db_user = crud.resolve_alias(db, alias=alias)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user.rides
+    try:
+        participations = crud.get_user_participations(db, participant_id=db_user.id, limit=limit, cursor=cursor, status=status)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if participations and len(participations) == limit:
+        response.headers["X-Next-Cursor"] = crud.participation_cursor(participations[-1])
+    return participations
+
+@router.get("/usuarios/{alias}/rides/match", response_model=List[schemas.RideMatch])
+def match_rides(alias: str, destination: str, at: datetime, seats: int = 1, k: int = Query(5, ge=1, le=50),
+                db: Session = Depends(get_read_db)):
+    db_user = crud.resolve_alias(db, alias=alias)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return [candidate._asdict() for candidate in
+            crud.match_rides(db, destination=destination, at=at, seats=seats, k=k, exclude_driver=db_user.id)]
 
 @router.get("/usuarios/{alias}/rides/{ride_id}", response_model=schemas.Ride)
-def read_ride(alias: str, ride_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_alias(db, alias=alias)
+def read_ride(alias: str, ride_id: int, if_none_match: Optional[str] = Header(None),
+              db: Session = Depends(get_read_db)):
+    db_user = crud.resolve_alias(db, alias=alias)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride:
+    version = crud.get_ride_version(db, ride_id=ride_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Ride not found")
-    return db_ride
+    etag = weak_etag("ride", ride_id, version)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return json_response(ride_adapter, crud.get_ride(db, ride_id=ride_id), headers={"ETag": etag})
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/requestToJoin/{participant_alias}", response_model=schemas.RideParticipation)
 def request_to_join_ride(alias: str, ride_id: int, participant_alias: str, participation_details: schemas.RideParticipationCreate, db: Session = Depends(get_db)):
-    db_driver = crud.get_user_by_alias(db, alias=alias)
+    db_driver = crud.resolve_alias(db, alias=alias)
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride or db_ride.rideDriver.id != db_driver.id:
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
+    if not db_ride or db_ride.driver_id != db_driver.id:
         raise HTTPException(status_code=404, detail="Ride not found")
 
     if db_ride.status != "ready":
         raise HTTPException(status_code=422, detail="Ride is not ready to accept requests")
 
-    db_participant = crud.get_user_by_alias(db, alias=participant_alias)
+    db_participant = crud.resolve_alias(db, alias=participant_alias)
     if not db_participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
     if db_driver.id == db_participant.id:
         raise HTTPException(status_code=422, detail="Driver cannot join their own ride")
 
-    existing_participation = any(p.participant_id == db_participant.id for p in db_ride.participants)
-    if existing_participation:
-        raise HTTPException(status_code=422, detail="Participant has already requested to join this ride")
-
-    return crud.create_ride_participation(db=db, ride_id=ride_id, user_id=db_participant.id, details=participation_details)
+    try:
+        return crud.create_ride_participation(db=db, ride_id=ride_id, user_id=db_participant.id, details=participation_details)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/accept/{participant_alias}")
 def accept_ride_request(alias: str, ride_id: int, participant_alias: str, db: Session = Depends(get_db)):
-    db_driver = crud.get_user_by_alias(db, alias=alias)
+    db_driver = crud.resolve_alias(db, alias=alias)
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride or db_ride.rideDriver.id != db_driver.id:
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
+    if not db_ride or db_ride.driver_id != db_driver.id:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    db_participant = crud.get_user_by_alias(db, alias=participant_alias)
+    db_participant = crud.resolve_alias(db, alias=participant_alias)
     if not db_participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
-    participation = next((p for p in db_ride.participants if p.participant_id == db_participant.id), None)
+    participation = crud.get_ride_participation(db, ride_id=ride_id, participant_id=db_participant.id)
     if not participation:
         raise HTTPException(status_code=404, detail="Participation request not found")
 
     if participation.status != "waiting":
         raise HTTPException(status_code=422, detail="Participation request is not waiting for confirmation")
 
-    confirmed_spaces = sum(p.occupiedSpaces for p in db_ride.participants if p.status == 'confirmed')
-    if db_ride.allowedSpaces < confirmed_spaces + participation.occupiedSpaces:
-        raise HTTPException(status_code=422, detail="Not enough spaces available")
-
-    participation.status = "confirmed"
-    participation.confirmation = datetime.utcnow()
-    db.commit()
+    try:
+        crud.confirm_ride_participation(db, participation)
+    except crud.ConflictError as e:
+        raise _conflict(e)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     return {"message": "Ride request accepted"}
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/reject/{participant_alias}")
 def reject_ride_request(alias: str, ride_id: int, participant_alias: str, db: Session = Depends(get_db)):
-    db_driver = crud.get_user_by_alias(db, alias=alias)
+    db_driver = crud.resolve_alias(db, alias=alias)
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride or db_ride.rideDriver.id != db_driver.id:
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
+    if not db_ride or db_ride.driver_id != db_driver.id:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    db_participant = crud.get_user_by_alias(db, alias=participant_alias)
+    db_participant = crud.resolve_alias(db, alias=participant_alias)
     if not db_participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
-    participation = next((p for p in db_ride.participants if p.participant_id == db_participant.id), None)
+    participation = crud.get_ride_participation(db, ride_id=ride_id, participant_id=db_participant.id)
     if not participation:
         raise HTTPException(status_code=404, detail="Participation request not found")
 
     if participation.status != "waiting":
         raise HTTPException(status_code=422, detail="Participation request is not waiting for confirmation")
 
-    participation.status = "rejected"
-    db.commit()
+    try:
+        crud.reject_ride_participation(db, participation)
+    except crud.ConflictError as e:
+        raise _conflict(e)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     return {"message": "Ride request rejected"}
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/start")
 def start_ride(alias: str, ride_id: int, db: Session = Depends(get_db)):
-    db_driver = crud.get_user_by_alias(db, alias=alias)
+    db_driver = crud.resolve_alias(db, alias=alias)
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride or db_ride.rideDriver.id != db_driver.id:
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
+    if not db_ride or db_ride.driver_id != db_driver.id:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    if any(p.status == "waiting" for p in db_ride.participants):
-        raise HTTPException(status_code=422, detail="There are pending participation requests")
-
-    db_ride.status = "inprogress"
-    for p in db_ride.participants:
-        if p.status == "confirmed":
-            p.status = "inprogress"
-        else:
-            p.status = "missing"
-    db.commit()
+    try:
+        crud.start_ride(db, ride_id=ride_id, version=db_ride.version)
+    except crud.ConflictError as e:
+        raise _conflict(e)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     return {"message": "Ride started"}
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/end")
 def end_ride(alias: str, ride_id: int, db: Session = Depends(get_db)):
-    db_driver = crud.get_user_by_alias(db, alias=alias)
+    db_driver = crud.resolve_alias(db, alias=alias)
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
-    if not db_ride or db_ride.rideDriver.id != db_driver.id:
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
+    if not db_ride or db_ride.driver_id != db_driver.id:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    db_ride.status = "done"
-    for p in db_ride.participants:
-        if p.status == "inprogress":
-            p.status = "notmarked"
-    db.commit()
+    try:
+        crud.end_ride(db, ride_id=ride_id, version=db_ride.version)
+    except crud.ConflictError as e:
+        raise _conflict(e)
     return {"message": "Ride ended"}
 
 @router.post("/usuarios/{alias}/rides/{ride_id}/unloadParticipant")
 def unload_participant(alias: str, ride_id: int, db: Session = Depends(get_db)):
-    db_participant = crud.get_user_by_alias(db, alias=alias)
+    db_participant = crud.resolve_alias(db, alias=alias)
     if not db_participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
-    db_ride = crud.get_ride(db, ride_id=ride_id)
+    db_ride = crud.get_ride(db, ride_id=ride_id, profile="ride_only")
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    participation = next((p for p in db_ride.participants if p.participant_id == db_participant.id), None)
+    participation = crud.get_ride_participation(db, ride_id=ride_id, participant_id=db_participant.id)
     if not participation:
         raise HTTPException(status_code=404, detail="Participant not in this ride")
 
     if participation.status != "inprogress":
         raise HTTPException(status_code=422, detail="Participant is not in an in-progress ride")
 
-    participation.status = "done"
-    db.commit()
+    try:
+        crud.unload_ride_participation(db, participation)
+    except crud.ConflictError as e:
+        raise _conflict(e)
     return {"message": "Participant unloaded"}
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from .. import crud
 from ..models import models
 from ..schemas import schemas
-from ..database.database import SessionLocal
+from ..schemas.serializers import json_response, user_adapter, user_list_adapter
+from ..database.database import SessionLocal, ReadSessionLocal
+from ..etag import etag_matches, weak_etag
+from ..profiling import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 def get_db():
     db = SessionLocal()
@@ -15,6 +18,13 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 @router.post("/usuarios/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_alias(db, alias=user.alias)
@@ -22,14 +32,31 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Alias already registered")
     return crud.create_user(db=db, user=user)
 
+@router.post("/usuarios/bulk", response_model=List[schemas.UserBulkResult])
+def create_users_bulk(users: List[schemas.UserCreate], db: Session = Depends(get_db)):
+    return crud.create_users_bulk(db=db, users=users)
+
 @router.get("/usuarios/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+def read_users(skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+               if_none_match: Optional[str] = Header(None), db: Session = Depends(get_read_db)):
+    try:
+        users = crud.get_users(db, skip=skip, limit=limit, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = {"ETag": weak_etag("users", [(u.id, u.alias, u.name, u.carPlate) for u in users])}
+    if users and len(users) == limit:
+        headers["X-Next-Cursor"] = crud.user_cursor(users[-1])
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return json_response(user_list_adapter, users, headers=headers)
 
 @router.get("/usuarios/{alias}", response_model=schemas.User)
-def read_user(alias: str, db: Session = Depends(get_db)):
+def read_user(alias: str, if_none_match: Optional[str] = Header(None),
+              db: Session = Depends(get_read_db)):
     db_user = crud.get_user_by_alias(db, alias=alias)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    etag = weak_etag("user", db_user.id, db_user.alias, db_user.name, db_user.carPlate)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return json_response(user_adapter, db_user, headers={"ETag": etag})
@@ -16,6 +16,11 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
+class UserBulkResult(BaseModel):
+    alias: str
+    status: str
+    id: Optional[int] = None
+
 class RideParticipationBase(BaseModel):
     destination: str
     occupiedSpaces: int
@@ -43,8 +48,37 @@ class RideCreate(RideBase):
 class Ride(RideBase):
     id: int
     status: str
-    rideDriver: User
+    freeSeats: int
+    # driver_id is nullable, e.g. for rides whose driver was removed.
+    rideDriver: Optional[User] = None
     participants: List[RideParticipation] = []
 
     class Config:
         orm_mode = True
+
+class RideSummary(RideBase):
+    id: int
+    status: str
+    freeSeats: int
+
+    class Config:
+        orm_mode = True
+
+class UserParticipation(RideParticipationBase):
+    id: int
+    confirmation: Optional[datetime] = None
+    status: str
+    ride: RideSummary
+
+    class Config:
+        orm_mode = True
+
+class RideMatch(BaseModel):
+    id: int
+    rideDateAndTime: datetime
+    finalAddress: str
+    freeSeats: int
+    score: float
+
+    class Config:
+        orm_mode = True
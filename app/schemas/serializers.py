@@ -0,0 +1,26 @@
+from fastapi import Response
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+from typing import List, Optional
+from . import schemas
+
+# Built once at import time. Routes that return these payloads validate the
+# ORM objects once and let pydantic-core write the JSON bytes directly,
+# instead of FastAPI's response_model round trip through Python dicts and
+# json.dumps. The routes keep their response_model for the OpenAPI schema.
+ride_adapter = TypeAdapter(schemas.Ride)
+ride_list_adapter = TypeAdapter(List[schemas.Ride])
+user_adapter = TypeAdapter(schemas.User)
+user_list_adapter = TypeAdapter(List[schemas.User])
+
+def dump_json(adapter: TypeAdapter, data):
+    return adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+
+def json_response(adapter: TypeAdapter, data, headers: Optional[dict] = None):
+    return Response(content=dump_json(adapter, data), media_type="application/json", headers=headers)
+
+def projection_response(rows, fields: List[str], headers: Optional[dict] = None):
+    # Column-only rows (e.g. a fields= subset of RideSummary) are plain values
+    # read from the database, so they are written out without validation.
+    content = to_json([{field: getattr(row, field) for field in fields} for row in rows])
+    return Response(content=content, media_type="application/json", headers=headers)
@@ -0,0 +1,214 @@
+"""Synthetic data generator.
+
+    python -m app.seed --users 100000 --rides 1000000 --participations 5000000 --seed 42
+
+Rows are generated in id order and bulk-inserted with Core INSERT statements
+executed over batches of parameters, committing every --commit-every rows. On SQLite
+fsyncs are turned off and the secondary indexes and search index are
+dropped for the load, then rebuilt once at the end. The same
+arguments and --seed always produce the same data.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.schema import CreateIndex
+
+from app.database.database import DATABASE_URL, SQLITE_PRAGMAS, _is_sqlite, create_db_engine
+from app.database.migrations import run_migrations
+from app.models import models
+from app.models.models import RIDES_FTS_DDL, RIDES_FTS_REBUILD
+
+STREETS = [
+    "Av Javier Prado", "Av Aramburú", "Av Arequipa", "Av La Marina", "Av Angamos", "Av Benavides",
+    "Av Primavera", "Av Larco", "Jr. Medrano Silva", "Av Universitaria", "Av Brasil", "Av Salaverry",
+]
+DISTRICTS = [
+    "San Borja", "Surquillo", "Miraflores", "San Isidro", "Barranco", "Santiago de Surco",
+    "Lince", "Jesús María", "Pueblo Libre", "San Miguel", "La Molina", "Chorrillos",
+]
+BASE_DATE = datetime(2025, 7, 15, 7, 0)
+DRIVER_RATIO = 0.3
+# Share of rides per status.
+RIDE_STATUSES = [("ready", 0.7), ("inprogress", 0.1), ("done", 0.2)]
+# Participation statuses that hold seats, per ride status.
+SEATED = {"ready": {"confirmed"}, "inprogress": {"inprogress", "done"}, "done": {"done", "notmarked"}}
+
+LOAD_PRAGMAS = {"synchronous": "OFF", "cache_size": -256000}
+
+TABLES = (models.User.__table__, models.Ride.__table__, models.RideParticipation.__table__)
+
+def address(rng: random.Random):
+    return f"{rng.choice(STREETS)} {rng.randint(100, 3000)}, {rng.choice(DISTRICTS)}"
+
+def _ride_status(rng: random.Random):
+    roll = rng.random()
+    for status, share in RIDE_STATUSES:
+        if roll < share:
+            return status
+        roll -= share
+    return RIDE_STATUSES[-1][0]
+
+def _participation_status(rng: random.Random, ride_status: str, seats_left: int, occupied: int):
+    roll = rng.random()
+    if ride_status == "ready":
+        if roll < 0.35 and occupied <= seats_left:
+            return "confirmed"
+        return "waiting" if roll < 0.85 else "rejected"
+    confirmed = occupied <= seats_left and roll < 0.8
+    if ride_status == "inprogress":
+        return rng.choice(["inprogress", "done"]) if confirmed else "missing"
+    return rng.choice(["done", "notmarked"]) if confirmed else "missing"
+
+def generate(users: int, rides: int, participations: int, seed: int = 0):
+    """Yields (table, row) pairs with ids assigned in order.
+
+    A ride is yielded before its participations, and confirmedSpaces matches
+    the seats held by them.
+    """
+    rng = random.Random(seed)
+    drivers = []
+    for user_id in range(1, users + 1):
+        is_driver = rng.random() < DRIVER_RATIO or user_id == 1
+        if is_driver:
+            drivers.append(user_id)
+        yield models.User.__table__, {
+            "id": user_id, "alias": f"user{user_id}", "name": f"User {user_id}",
+            "carPlate": f"ABC-{user_id:06d}" if is_driver else None,
+        }
+
+    participation_id = 0
+    for ride_id in range(1, rides + 1):
+        driver_id = rng.choice(drivers)
+        status = _ride_status(rng)
+        allowed = rng.randint(1, 4)
+        # Spread participations evenly so the total is exactly the requested one.
+        count = min(users - 1, participations * ride_id // rides - participations * (ride_id - 1) // rides)
+        participants = [p for p in rng.sample(range(1, users + 1), min(users, count + 1)) if p != driver_id][:count]
+        seats_left = allowed
+        rows = []
+        for participant_id in participants:
+            occupied = rng.randint(1, 2)
+            participation_status = _participation_status(rng, status, seats_left, occupied)
+            if participation_status in SEATED[status]:
+                seats_left -= occupied
+            participation_id += 1
+            rows.append({
+                "id": participation_id, "ride_id": ride_id, "participant_id": participant_id,
+                "destination": address(rng), "occupiedSpaces": occupied, "status": participation_status,
+                "confirmation": BASE_DATE if participation_status in SEATED[status] else None,
+            })
+        yield models.Ride.__table__, {
+            "id": ride_id, "driver_id": driver_id, "status": status, "allowedSpaces": allowed,
+            "confirmedSpaces": allowed - seats_left, "version": 1, "finalAddress": address(rng),
+            "rideDateAndTime": BASE_DATE + timedelta(minutes=rng.randint(-60 * 24 * 60, 60 * 24 * 60)),
+        }
+        yield from ((models.RideParticipation.__table__, row) for row in rows)
+
+def _set_pragmas(connection, pragmas: dict):
+    for name, value in pragmas.items():
+        connection.exec_driver_sql(f"PRAGMA {name}={value}")
+
+def _drop_derived(connection):
+    # Secondary indexes and the search triggers are maintained row by row;
+    # building them once after the load is several times faster.
+    for statement in RIDES_FTS_DDL:
+        if statement.startswith("CREATE TRIGGER"):
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {statement.split()[5]}")
+    for table in TABLES:
+        for index in table.indexes:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+
+def _build_derived(connection):
+    for table in TABLES:
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+    for statement in RIDES_FTS_DDL + RIDES_FTS_REBUILD:
+        connection.exec_driver_sql(statement)
+
+def _insert(connection, table, rows):
+    # A single compiled INSERT executed over the whole batch (DBAPI
+    # executemany). Rendering the batch as one multi-row VALUES clause makes
+    # SQLAlchemy build a bind parameter per value, which costs more than the
+    # insert itself.
+    if rows:
+        connection.execute(insert(table), rows)
+
+def seed(engine, users: int, rides: int, participations: int, seed: int = 0,
+         commit_every: int = 200000, progress=None):
+    """Loads the generated rows into an empty database and returns the row counts per table."""
+    counts = {table.name: 0 for table in TABLES}
+    pending = {table: [] for table in TABLES}
+    sqlite = _is_sqlite(str(engine.url))
+    with engine.connect() as connection:
+        if sqlite:
+            _set_pragmas(connection, LOAD_PRAGMAS)
+            _drop_derived(connection)
+            connection.commit()
+        try:
+            buffered = 0
+            for table, row in generate(users, rides, participations, seed):
+                pending[table].append(row)
+                counts[table.name] += 1
+                buffered += 1
+                if buffered >= commit_every:
+                    # Tables in dependency order: rides before the participations referencing them.
+                    for name in TABLES:
+                        _insert(connection, name, pending[name])
+                        pending[name] = []
+                    connection.commit()
+                    buffered = 0
+                    if progress:
+                        progress(counts)
+            for table in TABLES:
+                _insert(connection, table, pending[table])
+            connection.commit()
+        finally:
+            if sqlite:
+                _build_derived(connection)
+                connection.commit()
+                _set_pragmas(connection, {name: SQLITE_PRAGMAS[name] for name in LOAD_PRAGMAS})
+                connection.commit()
+    return counts
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rides", type=int, default=5000)
+    parser.add_argument("--participations", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--commit-every", type=int, default=200000, help="rows per transaction")
+    parser.add_argument("--reset", action="store_true", help="drop existing tables before loading")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    engine = create_db_engine(args.database_url)
+    if args.reset:
+        models.Base.metadata.drop_all(bind=engine)
+    run_migrations(engine)
+    with engine.connect() as connection:
+        existing = connection.exec_driver_sql("SELECT COUNT(*) FROM users").scalar()
+    if existing:
+        raise SystemExit(f"{engine.url.render_as_string(hide_password=True)} already has data; use --reset to replace it")
+
+    start = time.perf_counter()
+
+    def progress(counts):
+        total = sum(counts.values())
+        print(f"  {total} rows, {total / (time.perf_counter() - start):,.0f} rows/s", flush=True)
+
+    counts = seed(engine, args.users, args.rides, args.participations, seed=args.seed,
+                  commit_every=args.commit_every, progress=progress)
+    elapsed = time.perf_counter() - start
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+    total = sum(counts.values())
+    print(f"Loaded {total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
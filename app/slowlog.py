@@ -0,0 +1,96 @@
+"""Opt-in log of slow SQL statements.
+
+Set SLOW_QUERY_MS to record every statement that takes at least that long.
+Each record keeps the parameters, the route that ran it and, on SQLite, the
+EXPLAIN QUERY PLAN output with full table scans flagged. Records go to the
+log as JSON and to a bounded buffer served at /debug/slow-queries.
+"""
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = os.getenv("SLOW_QUERY_MS")
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+
+# "SCAN rides" (or "SCAN TABLE rides" before SQLite 3.36) reads the whole
+# table. Index walks ("... USING INDEX"), virtual tables (FTS), subqueries and
+# constant rows carry extra text and are not flagged.
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(?!CONSTANT ROW$)\w+(?: AS \w+)?$")
+EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")
+
+def full_scans(plan):
+    return [detail.strip() for detail in plan if FULL_SCAN.match(detail.strip())]
+
+def explain(dbapi_connection, statement: str, parameters):
+    # Runs on a separate DBAPI cursor so neither the caller's results nor
+    # the engine events are touched.
+    cursor = dbapi_connection.cursor()
+    try:
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append("  " * depth[node_id] + detail)
+    return plan
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: Optional[float] = None, maxsize: int = SLOW_QUERY_LOG_SIZE):
+        self.threshold_ms = threshold_ms
+        self._records = deque(maxlen=maxsize)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold_ms is not None
+
+    def is_slow(self, seconds: float):
+        return self.threshold_ms is not None and seconds * 1000 >= self.threshold_ms
+
+    def record(self, dbapi_connection, dialect: str, statement: str, parameters, executemany: bool, seconds: float):
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        plan = None
+        if dialect == "sqlite" and statement.lstrip().upper().startswith(EXPLAINABLE):
+            plan = explain(dbapi_connection, statement, parameters)
+        stats = metrics.current_request.get()
+        entry = {
+            "id": next(self._ids),
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_ms": round(seconds * 1000, 3),
+            "route": stats.route if stats else None,
+            "statement": statement,
+            "parameters": list(parameters) if isinstance(parameters, (list, tuple)) else parameters,
+            "executemany": executemany,
+            "plan": plan,
+            "full_scans": full_scans(plan or []),
+        }
+        with self._lock:
+            self._records.append(entry)
+        logger.warning("Slow query %s", json.dumps(entry, default=str))
+        return entry
+
+    def records(self):
+        with self._lock:
+            return list(reversed(self._records))
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+slow_query_log = SlowQueryLog(float(SLOW_QUERY_MS) if SLOW_QUERY_MS else None)
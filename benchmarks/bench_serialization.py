@@ -0,0 +1,80 @@
+"""Compare FastAPI's response_model serialization with the TypeAdapter path.
+
+Builds a page of rides with participants in memory (no database) and times
+both ways of turning it into JSON bytes:
+
+    python -m benchmarks.bench_serialization --rides 100 --participants 3
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import List
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from app.models import models
+from app.schemas import schemas
+from app.schemas.serializers import dump_json, ride_list_adapter
+
+def build_rides(count: int, participants: int):
+    driver = models.User(id=1, alias="driver", name="Driver User", carPlate="DRIVE-123")
+    rides = []
+    for ride_id in range(1, count + 1):
+        ride = models.Ride(
+            id=ride_id, rideDateAndTime=datetime(2025, 7, 15, 22, 0), finalAddress=f"Address {ride_id}",
+            allowedSpaces=participants + 1, confirmedSpaces=0, driver_id=1, status="ready", version=1
+        )
+        ride.rideDriver = driver
+        for n in range(participants):
+            user = models.User(id=1000 + n, alias=f"p{n}", name=f"Participant {n}")
+            ride.participants.append(models.RideParticipation(
+                id=ride_id * 100 + n, destination=f"Destination {n}", occupiedSpaces=1,
+                status="waiting", participant=user
+            ))
+        rides.append(ride)
+    return rides
+
+def fastapi_path(field, rides):
+    # What FastAPI does for a response_model: validate, build Python
+    # structures, then JSONResponse.render -> json.dumps.
+    content = asyncio.run(serialize_response(field=field, response_content=rides, is_coroutine=False))
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def adapter_path(rides):
+    return dump_json(ride_list_adapter, rides)
+
+def measure(fn, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rides", type=int, default=100)
+    parser.add_argument("--participants", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rides = build_rides(args.rides, args.participants)
+    field = create_model_field(name="Response_read_rides", type_=List[schemas.Ride], mode="serialization")
+    assert json.loads(fastapi_path(field, rides)) == json.loads(adapter_path(rides))
+
+    response_model_ms = measure(lambda: fastapi_path(field, rides), args.repeat)
+    adapter_ms = measure(lambda: adapter_path(rides), args.repeat)
+    print(json.dumps({
+        "rides": args.rides,
+        "participants_per_ride": args.participants,
+        "response_model_p50_ms": round(response_model_ms, 3),
+        "type_adapter_p50_ms": round(adapter_ms, 3),
+        "speedup": round(response_model_ms / adapter_ms, 2),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""Endpoint benchmarks against a seeded synthetic dataset.
+
+Seeds a SQLite database (unless it already holds data), drives every route in
+app/routers/users.py and app/routers/rides.py in-process through TestClient
+at the requested concurrency levels, and reports throughput, p50/p95/p99
+latency and SQL statements per request for each endpoint as JSON:
+
+    python -m benchmarks.run --users 100000 --rides 1000000 --participations 5000000 \\
+        --concurrency 1,8,32 --requests 500 --output results.json
+
+Compare a run with a saved one (e.g. from another branch):
+
+    python -m benchmarks.run --output branch.json --baseline results.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "sqlite:///./bench.db"))
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rides", type=int, default=50000)
+    parser.add_argument("--participations", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reseed", action="store_true", help="drop and seed the database again")
+    parser.add_argument("--concurrency", default="1,8", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and concurrency level")
+    parser.add_argument("--query-samples", type=int, default=5, help="sequential requests used to count queries")
+    parser.add_argument("--endpoints", default="", help="comma-separated subset of endpoint names")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    return parser.parse_args(argv)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class Workload:
+    """Targets for each endpoint, read from the seeded database.
+
+    Write endpoints consume their targets (a waiting request can only be
+    accepted once), so those lists are popped and may run out on small
+    datasets; exhausted requests are reported, not sent.
+    """
+
+    def __init__(self, connection, rng: random.Random, limit: int = 100000):
+        def rows(sql):
+            return [tuple(row) for row in connection.exec_driver_sql(f"{sql} LIMIT {limit}")]
+        self.rng = rng
+        self.users = [row[0] for row in rows("SELECT alias FROM users")]
+        self.drivers = [row[0] for row in rows("SELECT alias FROM users WHERE carPlate IS NOT NULL")]
+        self.ready_rides = rows(
+            "SELECT rides.id, users.alias FROM rides JOIN users ON users.id = rides.driver_id WHERE rides.status = 'ready'"
+        )
+        self.waiting = rows(
+            "SELECT p.ride_id, d.alias, u.alias FROM ride_participations p JOIN rides r ON r.id = p.ride_id "
+            "JOIN users d ON d.id = r.driver_id JOIN users u ON u.id = p.participant_id "
+            "WHERE p.status = 'waiting' AND r.status = 'ready'"
+        )
+        rng.shuffle(self.waiting)
+        half = len(self.waiting) // 2
+        self.to_accept, self.to_reject = self.waiting[:half], self.waiting[half:]
+        self.startable = rows(
+            "SELECT r.id, d.alias FROM rides r JOIN users d ON d.id = r.driver_id WHERE r.status = 'ready' "
+            "AND NOT EXISTS (SELECT 1 FROM ride_participations p WHERE p.ride_id = r.id AND p.status = 'waiting')"
+        )
+        self.in_progress = rows(
+            "SELECT r.id, d.alias FROM rides r JOIN users d ON d.id = r.driver_id WHERE r.status = 'inprogress'"
+        )
+        self.unloadable = rows(
+            "SELECT p.ride_id, u.alias FROM ride_participations p JOIN users u ON u.id = p.participant_id "
+            "WHERE p.status = 'inprogress'"
+        )
+        for targets in (self.startable, self.in_progress, self.unloadable):
+            rng.shuffle(targets)
+        self._lock = threading.Lock()
+
+    def pop(self, targets):
+        with self._lock:
+            return targets.pop() if targets else None
+
+    def pick(self, values):
+        with self._lock:
+            return self.rng.choice(values) if values else None
+
+def build_scenarios(workload: Workload, dataset):
+    # name -> function returning (method, path, json body) or None when exhausted.
+    def new_alias():
+        return f"bench-{uuid.uuid4().hex[:12]}"
+
+    def ride_request(action):
+        def build():
+            target = workload.pop(workload.to_accept if action == "accept" else workload.to_reject)
+            return target and ("POST", f"/usuarios/{target[1]}/rides/{target[0]}/{action}/{target[2]}", None)
+        return build
+
+    def request_to_join():
+        ride = workload.pick(workload.ready_rides)
+        participant = workload.pick(workload.users)
+        return ride and ("POST", f"/usuarios/{ride[1]}/rides/{ride[0]}/requestToJoin/{participant}",
+                         {"destination": dataset.address(workload.rng), "occupiedSpaces": 1})
+
+    def match():
+        at = dataset.BASE_DATE + timedelta(minutes=workload.rng.randint(-60 * 24 * 60, 60 * 24 * 60))
+        destination = workload.pick(dataset.DISTRICTS)
+        return ("GET", f"/usuarios/{workload.pick(workload.users)}/rides/match?destination={destination}"
+                       f"&at={at.isoformat()}&seats=1", None)
+
+    def read_ride():
+        ride = workload.pick(workload.ready_rides)
+        return ride and ("GET", f"/usuarios/{ride[1]}/rides/{ride[0]}", None)
+
+    def start():
+        ride = workload.pop(workload.startable)
+        return ride and ("POST", f"/usuarios/{ride[1]}/rides/{ride[0]}/start", None)
+
+    def end():
+        ride = workload.pop(workload.in_progress)
+        return ride and ("POST", f"/usuarios/{ride[1]}/rides/{ride[0]}/end", None)
+
+    def unload():
+        target = workload.pop(workload.unloadable)
+        return target and ("POST", f"/usuarios/{target[1]}/rides/{target[0]}/unloadParticipant", None)
+
+    return {
+        "POST /usuarios/": lambda: ("POST", "/usuarios/", {"alias": new_alias(), "name": "Bench User"}),
+        "POST /usuarios/bulk": lambda: ("POST", "/usuarios/bulk",
+                                        [{"alias": new_alias(), "name": "Bench User"} for _ in range(100)]),
+        "GET /usuarios/": lambda: ("GET", "/usuarios/?limit=100", None),
+        "GET /usuarios/{alias}": lambda: ("GET", f"/usuarios/{workload.pick(workload.users)}", None),
+        "POST /usuarios/{alias}/rides": lambda: ("POST", f"/usuarios/{workload.pick(workload.drivers)}/rides", {
+            "rideDateAndTime": dataset.BASE_DATE.isoformat(), "finalAddress": dataset.address(workload.rng),
+            "allowedSpaces": 3,
+        }),
+        "GET /rides": lambda: ("GET", "/rides?limit=100", None),
+        "GET /rides?view=summary": lambda: ("GET", "/rides?limit=100&view=summary", None),
+        "GET /rides/search": lambda: ("GET", f"/rides/search?q={workload.pick(dataset.DISTRICTS)}", None),
+        "GET /usuarios/{alias}/rides": lambda: ("GET", f"/usuarios/{workload.pick(workload.drivers)}/rides", None),
+        "GET /usuarios/{alias}/participations": lambda: (
+            "GET", f"/usuarios/{workload.pick(workload.users)}/participations", None),
+        "GET /usuarios/{alias}/rides/match": match,
+        "GET /usuarios/{alias}/rides/{ride_id}": read_ride,
+        "POST /usuarios/{alias}/rides/{ride_id}/requestToJoin/{participant_alias}": request_to_join,
+        "POST /usuarios/{alias}/rides/{ride_id}/accept/{participant_alias}": ride_request("accept"),
+        "POST /usuarios/{alias}/rides/{ride_id}/reject/{participant_alias}": ride_request("reject"),
+        "POST /usuarios/{alias}/rides/{ride_id}/start": start,
+        "POST /usuarios/{alias}/rides/{ride_id}/unloadParticipant": unload,
+        "POST /usuarios/{alias}/rides/{ride_id}/end": end,
+    }
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+def run_level(client_factory, build, requests: int, concurrency: int):
+    local = threading.local()
+
+    def one(_):
+        request = build()
+        if request is None:
+            return None
+        if not hasattr(local, "client"):
+            local.client = client_factory()
+        method, path, body = request
+        start = time.perf_counter()
+        response = local.client.request(method, path, json=body)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    done = [r for r in results if r is not None]
+    latencies = sorted(r[0] * 1000 for r in done)
+    statuses = {}
+    for _, status in done:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(done),
+        "exhausted": len(results) - len(done),
+        "throughput_rps": round(len(done) / wall, 2) if wall else None,
+        "p50_ms": round(percentile(latencies, 0.50), 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "status_codes": statuses,
+    }
+
+def count_queries(client, build, counter: QueryCounter, samples: int):
+    counts = []
+    for _ in range(samples):
+        request = build()
+        if request is None:
+            break
+        method, path, body = request
+        before = counter.count
+        client.request(method, path, json=body)
+        counts.append(counter.count - before)
+    if not counts:
+        return None
+    return {"mean": round(sum(counts) / len(counts), 2), "max": max(counts)}
+
+def compare(report, baseline):
+    lines = [f"{'endpoint':<72} {'c':>3} {'p50 Δ%':>8} {'p99 Δ%':>8} {'rps Δ%':>8} {'queries':>9}"]
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        for level, run in current["runs"].items():
+            before = previous["runs"].get(level)
+            if not before:
+                continue
+
+            def delta(key):
+                if not run.get(key) or not before.get(key):
+                    return "-"
+                return f"{100 * (run[key] - before[key]) / before[key]:+.1f}"
+            queries = f"{(previous.get('queries') or {}).get('mean', '-')}→{(current.get('queries') or {}).get('mean', '-')}"
+            lines.append(f"{name:<72} {level:>3} {delta('p50_ms'):>8} {delta('p99_ms'):>8} "
+                         f"{delta('throughput_rps'):>8} {queries:>9}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The app reads its configuration at import time.
+    os.environ["DATABASE_URL"] = args.database_url
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from app.database import database
+    from app.main import app
+    from app.models.models import Base
+    from app import seed as dataset
+
+    with database.engine.connect() as connection:
+        seeded = connection.exec_driver_sql("SELECT COUNT(*) FROM users").scalar()
+    if args.reseed or not seeded:
+        Base.metadata.drop_all(bind=database.engine)
+        database.init_db()
+        start = time.perf_counter()
+        counts = dataset.seed(database.engine, args.users, args.rides, args.participations, seed=args.seed)
+        print(f"Seeded {counts} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    with database.engine.connect() as connection:
+        workload = Workload(connection, random.Random(args.seed))
+        sizes = {table: connection.exec_driver_sql(f"SELECT COUNT(*) FROM {table}").scalar()
+                 for table in ("users", "rides", "ride_participations")}
+    scenarios = build_scenarios(workload, dataset)
+    if args.endpoints:
+        selected = {name.strip() for name in args.endpoints.split(",")}
+        scenarios = {name: build for name, build in scenarios.items() if name in selected}
+
+    def client_factory():
+        return TestClient(app, raise_server_exceptions=False)
+
+    counter = QueryCounter()
+    event.listen(Engine, "before_cursor_execute", counter)
+    levels = [int(level) for level in args.concurrency.split(",")]
+    report = {
+        "meta": {"database_url": args.database_url, "dataset": sizes, "concurrency": levels,
+                 "requests": args.requests, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "endpoints": {},
+    }
+    try:
+        sequential = client_factory()
+        for name, build in scenarios.items():
+            queries = count_queries(sequential, build, counter, args.query_samples)
+            runs = {str(level): run_level(client_factory, build, args.requests, level) for level in levels}
+            report["endpoints"][name] = {"queries": queries, "runs": runs}
+            print(f"{name}: {json.dumps(runs)}", file=sys.stderr)
+    finally:
+        event.remove(Engine, "before_cursor_execute", counter)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
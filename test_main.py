@@ -1,16 +1,20 @@
 import pytest
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 from app.main import app
+from app import crud
 from app.routers.users import get_db
 from app.models.models import Base
+from app.database.database import instrument_engine
 import os
 from datetime import datetime
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = instrument_engine(create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}))
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base.metadata.create_all(bind=engine)
@@ -24,13 +28,66 @@ def override_get_db():
 
 app.dependency_overrides[get_db] = override_get_db
 
+# Cada prueba recrea la base, así que la caché de alias se desactiva por defecto.
+crud.alias_cache.enabled = False
+
 client = TestClient(app)
 
+# Máximo de sentencias SQL por llamada a cada ruta, medido con alias no
+# cacheados y varios rides y participantes cargados: si un cambio introduce
+# consultas N+1, la ruta excede su presupuesto.
+QUERY_BUDGETS = {
+    "POST /usuarios/": 3,
+    "POST /usuarios/bulk": 2,
+    "GET /usuarios/": 1,
+    "GET /usuarios/{alias}": 1,
+    "POST /usuarios/{alias}/rides": 4,
+    "GET /rides": 3,
+    "GET /rides/search": 3,
+    "GET /usuarios/{alias}/rides": 4,
+    "GET /usuarios/{alias}/participations": 2,
+    "GET /usuarios/{alias}/rides/match": 2,
+    "GET /usuarios/{alias}/rides/{ride_id}": 4,
+    "POST /usuarios/{alias}/rides/{ride_id}/requestToJoin/{participant_alias}": 7,
+    "POST /usuarios/{alias}/rides/{ride_id}/accept/{participant_alias}": 7,
+    "POST /usuarios/{alias}/rides/{ride_id}/reject/{participant_alias}": 6,
+    "POST /usuarios/{alias}/rides/{ride_id}/start": 4,
+    "POST /usuarios/{alias}/rides/{ride_id}/end": 4,
+    "POST /usuarios/{alias}/rides/{ride_id}/unloadParticipant": 5,
+}
+
+@contextmanager
+def assert_max_queries(budget: int, label: str = "block"):
+    # Cuenta las sentencias de todos los engines mientras dura el bloque.
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    if len(statements) > budget:
+        listing = "\n".join(f"  {i}. {' '.join(statement.split())}" for i, statement in enumerate(statements, 1))
+        raise AssertionError(f"{label} ran {len(statements)} queries, budget is {budget}:\n{listing}")
+
+@pytest.fixture
+def query_budget():
+    # query_budget("GET /rides", "/rides?limit=5") hace la llamada dentro del presupuesto de la ruta.
+    def call(route: str, path: str, **kwargs):
+        method = route.split(" ", 1)[0]
+        with assert_max_queries(QUERY_BUDGETS[route], route):
+            return client.request(method, path, **kwargs)
+    return call
+
 @pytest.fixture(scope="function", autouse=True)
 def setup_and_teardown_db():
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
+    crud.ride_index.clear()
 
 def test_create_user_success():
     # Caso de prueba: Crear un usuario exitosamente.
@@ -607,3 +664,831 @@ def test_read_users_with_skip_and_limit():
     assert response.status_code == 200
     assert len(response.json()) == 1
     assert response.json()[0]["alias"] == "testuser2"
+
+def test_read_rides_includes_participants():
+    # Caso de prueba: Los rides listados incluyen al conductor y a los participantes con su usuario
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "p1", "name": "Participant 1"})
+    client.post("/usuarios/", json={"alias": "p2", "name": "Participant 2"})
+    for _ in range(3):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+        )
+    for ride_id in (1, 2, 3):
+        for alias in ("p1", "p2"):
+            client.post(
+                f"/usuarios/driver/rides/{ride_id}/requestToJoin/{alias}",
+                json={"destination": "Destination", "occupiedSpaces": 1}
+            )
+    response = client.get("/rides")
+    assert response.status_code == 200
+    rides = response.json()
+    assert len(rides) == 3
+    for ride in rides:
+        assert ride["rideDriver"]["alias"] == "driver"
+        assert sorted(p["participant"]["alias"] for p in ride["participants"]) == ["p1", "p2"]
+
+def test_read_rides_with_cursor():
+    # Caso de prueba: Paginar los rides con cursor, ordenados por fecha
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    for date in ("2025-07-15T22:00:00", "2025-07-14T22:00:00", "2025-07-15T22:00:00", "2025-07-13T22:00:00"):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": date, "finalAddress": "Test Address", "allowedSpaces": 3}
+        )
+    first = client.get("/rides?limit=2")
+    assert [r["id"] for r in first.json()] == [4, 2]
+    second = client.get(f"/rides?limit=2&cursor={first.headers['X-Next-Cursor']}")
+    assert [r["id"] for r in second.json()] == [1, 3]
+    third = client.get(f"/rides?limit=2&cursor={second.headers['X-Next-Cursor']}")
+    assert third.json() == []
+    assert "X-Next-Cursor" not in third.headers
+
+def test_read_users_with_cursor():
+    # Caso de prueba: Paginar los usuarios con cursor
+    for i in range(3):
+        client.post("/usuarios/", json={"alias": f"testuser{i}", "name": f"Test User {i}"})
+    first = client.get("/usuarios/?limit=2")
+    assert [u["alias"] for u in first.json()] == ["testuser0", "testuser1"]
+    second = client.get(f"/usuarios/?limit=2&cursor={first.headers['X-Next-Cursor']}")
+    assert [u["alias"] for u in second.json()] == ["testuser2"]
+    assert "X-Next-Cursor" not in second.headers
+
+def test_read_rides_invalid_cursor():
+    # Caso de prueba: Un cursor inválido devuelve 400
+    response = client.get("/rides?cursor=invalid")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+def test_accept_ride_request_updates_confirmed_spaces():
+    # Caso de prueba: Aceptar solicitudes mantiene el contador de asientos confirmados
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "p1", "name": "Participant 1"})
+    client.post("/usuarios/", json={"alias": "p2", "name": "Participant 2"})
+    client.post(
+        "/usuarios/driver/rides",
+        json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+    )
+    client.post("/usuarios/driver/rides/1/requestToJoin/p1", json={"destination": "P1 Destination", "occupiedSpaces": 2})
+    client.post("/usuarios/driver/rides/1/requestToJoin/p2", json={"destination": "P2 Destination", "occupiedSpaces": 2})
+    assert client.post("/usuarios/driver/rides/1/accept/p1").status_code == 200
+    response = client.post("/usuarios/driver/rides/1/accept/p2")
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Not enough spaces available"
+    from app.crud import get_ride_participation
+    from app.models.models import Ride
+    db = TestingSessionLocal()
+    assert db.get(Ride, 1).confirmedSpaces == 2
+    assert get_ride_participation(db, ride_id=1, participant_id=3).status == "waiting"
+    db.close()
+
+def test_start_and_end_ride_update_participations():
+    # Caso de prueba: Iniciar y terminar un ride actualiza el estado de todas las participaciones
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post(
+        "/usuarios/driver/rides",
+        json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+    )
+    for alias in ("p1", "p2", "p3"):
+        client.post("/usuarios/", json={"alias": alias, "name": alias})
+        client.post(f"/usuarios/driver/rides/1/requestToJoin/{alias}", json={"destination": "Destination", "occupiedSpaces": 1})
+    client.post("/usuarios/driver/rides/1/accept/p1")
+    client.post("/usuarios/driver/rides/1/accept/p2")
+    client.post("/usuarios/driver/rides/1/reject/p3")
+    assert client.post("/usuarios/driver/rides/1/start").status_code == 200
+    client.post("/usuarios/p1/rides/1/unloadParticipant")
+    ride = client.get("/usuarios/driver/rides/1").json()
+    assert ride["status"] == "inprogress"
+    assert {p["participant"]["alias"]: p["status"] for p in ride["participants"]} == {"p1": "done", "p2": "inprogress", "p3": "missing"}
+    assert client.post("/usuarios/driver/rides/1/end").status_code == 200
+    ride = client.get("/usuarios/driver/rides/1").json()
+    assert ride["status"] == "done"
+    assert {p["participant"]["alias"]: p["status"] for p in ride["participants"]} == {"p1": "done", "p2": "notmarked", "p3": "missing"}
+
+def test_database_engine_pragmas():
+    # Caso de prueba: El engine de la aplicación aplica WAL y los pragmas configurados
+    from app.database import database
+    pragmas = database.effective_pragmas()
+    assert pragmas["journal_mode"] == "wal"
+    assert pragmas["busy_timeout"] == database.SQLITE_PRAGMAS["busy_timeout"]
+    memory_engine = database.create_db_engine("sqlite://")
+    assert database.effective_pragmas(memory_engine)["journal_mode"] == "memory"
+    memory_engine.dispose()
+
+def test_startup_logs_effective_pragmas(caplog):
+    # Caso de prueba: Los logs de la aplicación salen en nivel INFO aunque el logger raíz quede en WARNING
+    import logging
+    from app.database import database
+    assert logging.getLogger("app.database.database").isEnabledFor(logging.INFO)
+    with caplog.at_level(logging.INFO, logger="app"):
+        database.init_db()
+    assert any("ready with pragmas" in record.getMessage() for record in caplog.records)
+
+def test_read_session_is_read_only():
+    # Caso de prueba: La sesión de lectura usa una conexión de solo lectura
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from app.database.database import ReadSessionLocal
+    client.post("/usuarios/", json={"alias": "testuser", "name": "Test User"})
+    db = ReadSessionLocal()
+    try:
+        assert db.execute(text("SELECT alias FROM users")).scalar() == "testuser"
+        with pytest.raises(OperationalError):
+            db.execute(text("DELETE FROM users"))
+    finally:
+        db.close()
+
+def test_alias_cache_lru_and_ttl():
+    # Caso de prueba: La caché de alias respeta el tamaño máximo, el TTL y cuenta aciertos y fallos
+    from app.cache import AliasCache, UserRef
+    cache = AliasCache(maxsize=2, ttl=60)
+    cache.put("a", UserRef(1, None))
+    cache.put("b", UserRef(2, "ABC-123"))
+    assert cache.get("a") == UserRef(1, None)
+    cache.put("c", UserRef(3, None))
+    assert cache.get("b") is None
+    assert cache.get("c") == UserRef(3, None)
+    cache.invalidate("c")
+    assert cache.get("c") is None
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 2}
+    expired = AliasCache(ttl=0)
+    expired.put("a", UserRef(1, None))
+    assert expired.get("a") is None
+
+def test_alias_cache_resolves_ride_endpoints():
+    # Caso de prueba: Los endpoints de rides resuelven alias desde la caché
+    crud.alias_cache.enabled = True
+    crud.alias_cache.clear()
+    try:
+        client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+        )
+        assert client.get("/usuarios/driver/rides").status_code == 200
+        assert crud.alias_cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+        lines = client.get("/metrics").text.splitlines()
+        assert {"alias_cache_hits_total 1", "alias_cache_misses_total 1", "alias_cache_size 1"} <= set(lines)
+        assert "# TYPE alias_cache_hits_total counter" in lines
+    finally:
+        crud.alias_cache.enabled = False
+        crud.alias_cache.clear()
+
+def test_read_ride_conditional_get():
+    # Caso de prueba: Un GET condicional devuelve 304 hasta que el ride cambia
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    client.post(
+        "/usuarios/driver/rides",
+        json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+    )
+    first = client.get("/usuarios/driver/rides/1")
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+    cached = client.get("/usuarios/driver/rides/1", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert client.get("/rides", headers={"If-None-Match": client.get("/rides").headers["ETag"]}).status_code == 304
+    client.post(
+        "/usuarios/driver/rides/1/requestToJoin/participant",
+        json={"destination": "Participant Destination", "occupiedSpaces": 1}
+    )
+    changed = client.get("/usuarios/driver/rides/1", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.json()["participants"]) == 1
+
+def test_read_user_conditional_get():
+    # Caso de prueba: Un GET condicional sobre un usuario sin cambios devuelve 304
+    client.post("/usuarios/", json={"alias": "testuser", "name": "Test User"})
+    etag = client.get("/usuarios/testuser").headers["ETag"]
+    assert client.get("/usuarios/testuser", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/usuarios/testuser", headers={"If-None-Match": 'W/"other"'}).status_code == 200
+
+def test_create_users_bulk():
+    # Caso de prueba: Crear usuarios en bloque reportando duplicados
+    client.post("/usuarios/", json={"alias": "existing", "name": "Existing User"})
+    response = client.post("/usuarios/bulk", json=[
+        {"alias": "bulk1", "name": "Bulk User 1", "carPlate": "BLK-001"},
+        {"alias": "existing", "name": "Existing Again"},
+        {"alias": "bulk2", "name": "Bulk User 2"},
+        {"alias": "bulk1", "name": "Repeated In Batch"},
+    ])
+    assert response.status_code == 200
+    results = response.json()
+    assert [(r["alias"], r["status"]) for r in results] == [
+        ("bulk1", "created"), ("existing", "duplicate"), ("bulk2", "created"), ("bulk1", "duplicate")
+    ]
+    assert results[0]["id"] == client.get("/usuarios/bulk1").json()["id"]
+    assert results[1]["id"] is None
+    assert client.get("/usuarios/bulk2").json()["name"] == "Bulk User 2"
+    assert len(client.get("/usuarios/").json()) == 3
+
+def test_export_rides_ndjson():
+    # Caso de prueba: Exportar rides como NDJSON con filtros de estado y fecha
+    import json
+    from app import crud
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    for date in ("2025-07-13T22:00:00", "2025-07-14T22:00:00", "2025-07-15T22:00:00"):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": date, "finalAddress": "Test Address", "allowedSpaces": 3}
+        )
+    client.post(
+        "/usuarios/driver/rides/2/requestToJoin/participant",
+        json={"destination": "Participant Destination", "occupiedSpaces": 1}
+    )
+    client.post("/usuarios/driver/rides/3/end")
+    batch_size = crud.EXPORT_BATCH_SIZE
+    crud.EXPORT_BATCH_SIZE = 1
+    try:
+        response = client.get("/export/rides.ndjson")
+    finally:
+        crud.EXPORT_BATCH_SIZE = batch_size
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rides = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["id"] for r in rides] == [1, 2, 3]
+    assert rides[1]["participants"][0]["participant"]["alias"] == "participant"
+    filtered = client.get("/export/rides.ndjson?status=ready&from=2025-07-14T00:00:00&to=2025-07-16T00:00:00")
+    assert [json.loads(line)["id"] for line in filtered.text.splitlines()] == [2]
+    # Un ride sin conductor no corta la exportación.
+    with engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE rides SET driver_id = NULL WHERE id = 2")
+    crud.EXPORT_BATCH_SIZE = 1
+    try:
+        response = client.get("/export/rides.ndjson")
+    finally:
+        crud.EXPORT_BATCH_SIZE = batch_size
+    rides = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["id"] for r in rides] == [1, 2, 3]
+    assert rides[1]["rideDriver"] is None
+
+def _create_old_schema(engine):
+    # Esquema y datos anteriores a las migraciones.
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE users (id INTEGER PRIMARY KEY, alias VARCHAR UNIQUE, name VARCHAR, carPlate VARCHAR)")
+        connection.exec_driver_sql(
+            "CREATE TABLE rides (id INTEGER PRIMARY KEY, rideDateAndTime DATETIME, finalAddress VARCHAR, "
+            "allowedSpaces INTEGER, driver_id INTEGER, status VARCHAR)"
+        )
+        connection.exec_driver_sql(
+            "CREATE TABLE ride_participations (id INTEGER PRIMARY KEY, confirmation DATETIME, destination VARCHAR, "
+            "occupiedSpaces INTEGER, status VARCHAR, ride_id INTEGER, participant_id INTEGER)"
+        )
+        connection.exec_driver_sql("INSERT INTO rides VALUES (1, '2025-07-15 22:00:00', 'Test Address', 3, 1, 'ready')")
+        connection.exec_driver_sql("INSERT INTO ride_participations VALUES (1, NULL, 'A', 2, 'confirmed', 1, 2)")
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    # Caso de prueba: Las migraciones agregan columnas e índices a una base existente y son idempotentes,
+    # y eliminan solicitudes duplicadas antes de crear el índice único
+    from sqlalchemy import inspect
+    from app.database.migrations import MIGRATIONS, run_migrations
+    old_engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    _create_old_schema(old_engine)
+    with old_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO ride_participations VALUES (2, NULL, 'B', 1, 'waiting', 1, 3)")
+        # Duplicado de la participación 1 creado por dos requests concurrentes.
+        connection.exec_driver_sql("INSERT INTO ride_participations VALUES (3, NULL, 'C', 1, 'confirmed', 1, 2)")
+    assert run_migrations(old_engine) == MIGRATIONS[-1][0]
+    assert run_migrations(old_engine) == MIGRATIONS[-1][0]
+    with old_engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT confirmedSpaces, version FROM rides").one() == (2, 1)
+        assert connection.exec_driver_sql("SELECT id, version FROM ride_participations").all() == [(1, 1), (2, 1)]
+        assert connection.exec_driver_sql("SELECT rowid, destinations FROM rides_fts").one() == (1, "A B")
+    inspector = inspect(old_engine)
+    ride_indexes = {i["name"] for i in inspector.get_indexes("rides")}
+    assert {"ix_rides_status_date_id", "ix_rides_driver_date"} <= ride_indexes
+    assert "ix_rides_driver_id" not in ride_indexes
+    participation_indexes = {i["name"]: i for i in inspector.get_indexes("ride_participations")}
+    assert participation_indexes["uq_ride_participations_ride_participant"]["unique"]
+    old_engine.dispose()
+
+def test_migrations_are_atomic_across_workers(tmp_path, monkeypatch):
+    # Caso de prueba: Varios workers migran la misma base a la vez sin fallar, y un paso fallido no deja cambios a medias
+    from concurrent.futures import ThreadPoolExecutor
+    from app.database import migrations
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    _create_old_schema(create_engine(url))
+
+    def failing_step(connection):
+        raise RuntimeError("worker died")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:1] + [(2, failing_step)])
+        with pytest.raises(RuntimeError):
+            migrations.run_migrations(create_engine(url))
+    with create_engine(url).connect() as connection:
+        # El ALTER del paso 1 se deshizo junto con el resto.
+        assert migrations.schema_version(connection) == 0
+        assert "confirmedSpaces" not in migrations._columns(connection, "rides")
+
+    engines = [create_engine(url, connect_args={"timeout": 30}) for _ in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        versions = list(pool.map(migrations.run_migrations, engines))
+    assert versions == [migrations.MIGRATIONS[-1][0]] * 4
+    with engines[0].connect() as connection:
+        assert connection.exec_driver_sql("SELECT confirmedSpaces FROM rides").scalar() == 2
+
+def test_read_rides_with_filters():
+    # Caso de prueba: Filtrar rides por ventana de tiempo y asientos libres, y ordenarlos
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    for date, spaces in (("2025-07-15T08:00:00", 3), ("2025-07-15T08:30:00", 2), ("2025-07-15T09:30:00", 4), ("2025-07-15T07:00:00", 4)):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": date, "finalAddress": "Test Address", "allowedSpaces": spaces}
+        )
+    client.post("/usuarios/driver/rides/1/requestToJoin/participant", json={"destination": "Destination", "occupiedSpaces": 2})
+    client.post("/usuarios/driver/rides/1/accept/participant")
+    response = client.get("/rides?from=2025-07-15T08:00:00&to=2025-07-15T09:00:00")
+    assert [(r["id"], r["freeSeats"]) for r in response.json()] == [(1, 1), (2, 2)]
+    response = client.get("/rides?from=2025-07-15T08:00:00&to=2025-07-15T09:00:00&minFreeSeats=2")
+    assert [r["id"] for r in response.json()] == [2]
+    response = client.get("/rides?sort=-date&limit=2")
+    assert [r["id"] for r in response.json()] == [3, 2]
+    response = client.get(f"/rides?sort=-date&limit=2&cursor={response.headers['X-Next-Cursor']}")
+    assert [r["id"] for r in response.json()] == [1, 4]
+    assert client.get("/rides?sort=price").status_code == 422
+
+def test_search_rides():
+    # Caso de prueba: Buscar rides por dirección final o destino de los participantes
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    for address in ("Av Javier Prado 456, San Borja", "Av Aramburú 245, Surquillo", "Jr. Medrano Silva 165, Barranco"):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": address, "allowedSpaces": 3}
+        )
+    client.post(
+        "/usuarios/driver/rides/3/requestToJoin/participant",
+        json={"destination": "Av Javier Prado 1200, San Isidro", "occupiedSpaces": 1}
+    )
+    response = client.get("/rides/search?q=javier prado")
+    assert response.status_code == 200
+    assert [r["id"] for r in response.json()] == [1, 3]
+    assert [r["id"] for r in client.get("/rides/search?q=aramburu").json()] == [2]
+    assert [r["id"] for r in client.get("/rides/search?q=surq").json()] == [2]
+    assert client.get('/rides/search?q="OR NEAR(').json() == []
+    client.post("/usuarios/driver/rides/1/end")
+    assert [r["id"] for r in client.get("/rides/search?q=javier prado").json()] == [3]
+
+def test_match_rides():
+    # Caso de prueba: Recomendar rides según destino, hora y asientos libres
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    client.post("/usuarios/", json={"alias": "other", "name": "Other User"})
+    rides = (
+        ("2025-07-15T08:00:00", "Av Javier Prado 456, San Borja", 3),
+        ("2025-07-15T08:30:00", "Av Javier Prado Este 2000, San Borja", 1),
+        ("2025-07-15T08:10:00", "Av Aramburú 245, Surquillo", 3),
+        ("2025-07-15T13:00:00", "Av Javier Prado 456, San Borja", 3),
+    )
+    for date, address, spaces in rides:
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": date, "finalAddress": address, "allowedSpaces": spaces}
+        )
+    url = "/usuarios/participant/rides/match?destination=San Borja&at=2025-07-15T08:05:00"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert [r["id"] for r in response.json()] == [1, 2]
+    assert [r["id"] for r in client.get(url + "&seats=2").json()] == [1]
+    # Con zona horaria, la hora se convierte a UTC antes de comparar.
+    for at in ("2025-07-15T08:05:00Z", "2025-07-15T08:05:00%2B00:00", "2025-07-15T03:05:00-05:00"):
+        response = client.get(f"/usuarios/participant/rides/match?destination=San Borja&at={at}")
+        assert response.status_code == 200
+        assert [r["id"] for r in response.json()] == [1, 2]
+    client.post("/usuarios/driver/rides/1/requestToJoin/other", json={"destination": "San Borja", "occupiedSpaces": 2})
+    client.post("/usuarios/driver/rides/1/accept/other")
+    assert client.get(url + "&seats=2").json() == []
+    client.post("/usuarios/driver/rides/2/start")
+    assert [r["id"] for r in client.get(url).json()] == [1]
+    assert client.get("/usuarios/driver/rides/match?destination=San Borja&at=2025-07-15T08:05:00").json() == []
+    assert client.get("/usuarios/nonexistent/rides/match?destination=x&at=2025-07-15T08:05:00").status_code == 404
+
+def test_ride_index_reloads_once_in_background():
+    # Caso de prueba: Al vencer el índice de rides, una sola recarga corre en segundo plano sin bloquear las búsquedas
+    import random
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import timedelta
+    from app.matching import RideIndex
+    base = datetime(2025, 7, 15, 8, 0)
+    rows = [(i, base + timedelta(minutes=i), f"Calle {i}, San Borja", 3, 99) for i in range(1, 201)]
+    random.Random(0).shuffle(rows)
+    index = RideIndex(max_age=0)
+    index.refresh(lambda: rows)
+    # Las filas llegan desordenadas y el índice queda ordenado por hora de salida.
+    assert index._by_time == sorted(index._by_time)
+    assert [c.id for c in index.match("San Borja", base + timedelta(minutes=50), k=3)] == [50, 49, 51]
+
+    gate, calls = threading.Event(), []
+
+    def slow_fetch():
+        calls.append(1)
+        gate.wait(5)
+        return [row for row in rows if row[0] <= 100]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: index.refresh(slow_fetch), range(8)))
+    # Mientras recarga, el índice anterior sigue respondiendo y recibe los cambios del proceso.
+    index.remove(50)
+    index.add(500, base + timedelta(minutes=50), "Av Javier Prado, San Borja", 2, 99)
+    assert [c.id for c in index.match("San Borja", base + timedelta(minutes=150), k=1)] == [150]
+    gate.set()
+    deadline = time.monotonic() + 5
+    while index._pending is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(calls) == 1
+    assert 150 not in index._entries and 50 not in index._entries and 500 in index._entries
+    assert index._by_time == sorted((e.departure, e.id) for e in index._entries.values())
+
+def test_read_user_participations():
+    # Caso de prueba: Listar las participaciones de un usuario con cursor y filtro de estado
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    for ride_id in (1, 2, 3):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": f"Address {ride_id}", "allowedSpaces": 3}
+        )
+        client.post(
+            f"/usuarios/driver/rides/{ride_id}/requestToJoin/participant",
+            json={"destination": "Participant Destination", "occupiedSpaces": 1}
+        )
+    client.post("/usuarios/driver/rides/2/accept/participant")
+    first = client.get("/usuarios/participant/participations?limit=2")
+    assert first.status_code == 200
+    assert [(p["id"], p["ride"]["finalAddress"]) for p in first.json()] == [(1, "Address 1"), (2, "Address 2")]
+    second = client.get(f"/usuarios/participant/participations?limit=2&cursor={first.headers['X-Next-Cursor']}")
+    assert [p["ride"]["id"] for p in second.json()] == [3]
+    confirmed = client.get("/usuarios/participant/participations?status=confirmed").json()
+    assert [(p["ride"]["id"], p["ride"]["freeSeats"]) for p in confirmed] == [(2, 2)]
+    assert client.get("/usuarios/driver/participations").json() == []
+    assert client.get("/usuarios/nonexistent/participations").status_code == 404
+
+def test_read_user_rides_paginated():
+    # Caso de prueba: Listar los rides de un conductor con cursor y filtro de estado
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    for date in ("2025-07-15T22:00:00", "2025-07-14T22:00:00", "2025-07-16T22:00:00"):
+        client.post(
+            "/usuarios/driver/rides",
+            json={"rideDateAndTime": date, "finalAddress": "Test Address", "allowedSpaces": 3}
+        )
+    client.post("/usuarios/driver/rides/2/end")
+    first = client.get("/usuarios/driver/rides?limit=2")
+    assert [r["id"] for r in first.json()] == [2, 1]
+    second = client.get(f"/usuarios/driver/rides?limit=2&cursor={first.headers['X-Next-Cursor']}")
+    assert [r["id"] for r in second.json()] == [3]
+    assert [r["id"] for r in client.get("/usuarios/driver/rides?status=ready").json()] == [1, 3]
+
+def test_read_rides_summary_view():
+    # Caso de prueba: Listar rides en vista resumida o con campos seleccionados
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post(
+        "/usuarios/driver/rides",
+        json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+    )
+    response = client.get("/rides?view=summary")
+    assert response.status_code == 200
+    assert response.json() == [{
+        "id": 1, "rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address",
+        "allowedSpaces": 3, "status": "ready", "freeSeats": 3
+    }]
+    response = client.get("/usuarios/driver/rides?fields=id,freeSeats")
+    assert response.json() == [{"id": 1, "freeSeats": 3}]
+    assert client.get("/usuarios/driver/rides?fields=id,freeSeats", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/usuarios/driver/rides", headers={"If-None-Match": response.headers["ETag"]}).status_code == 200
+    response = client.get("/rides?fields=id,rideDriver")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unknown fields: rideDriver"
+
+def test_seed_generates_consistent_reproducible_data(tmp_path):
+    # Caso de prueba: El generador es reproducible, respeta los cupos y reconstruye índices y búsqueda tras la carga
+    from sqlalchemy import inspect
+    from app import seed
+    from app.database.database import create_db_engine
+    from app.database.migrations import run_migrations
+    assert list(seed.generate(20, 50, 120, seed=7)) == list(seed.generate(20, 50, 120, seed=7))
+    seed_engine = create_db_engine(f"sqlite:///{tmp_path / 'seed.db'}")
+    Base.metadata.create_all(bind=seed_engine)
+    run_migrations(seed_engine)
+    counts = seed.seed(seed_engine, 20, 50, 120, seed=7, commit_every=40)
+    assert counts == {"users": 20, "rides": 50, "ride_participations": 120}
+    with seed_engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT COUNT(*) FROM rides WHERE confirmedSpaces > allowedSpaces OR confirmedSpaces != ("
+            "SELECT COALESCE(SUM(occupiedSpaces), 0) FROM ride_participations p WHERE p.ride_id = rides.id "
+            "AND p.status IN ('confirmed', 'inprogress', 'done', 'notmarked'))"
+        ).scalar() == 0
+        assert connection.exec_driver_sql("SELECT COUNT(*) FROM rides_fts").scalar() == 50
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    assert "uq_ride_participations_ride_participant" in {i["name"] for i in inspect(seed_engine).get_indexes("ride_participations")}
+    seed_engine.dispose()
+
+def test_metrics_endpoint():
+    # Caso de prueba: /metrics expone conteos, latencias y consultas SQL por ruta en formato Prometheus
+    from app.metrics import registry
+    registry.clear()
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})
+    client.get("/usuarios/driver")
+    client.get("/usuarios/nobody")
+    client.get("/no/such/path")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'http_requests_total{method="GET",route="/usuarios/{alias}",status="200"} 1' in lines
+    assert 'http_requests_total{method="GET",route="/usuarios/{alias}",status="404"} 1' in lines
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in lines
+    assert 'http_request_duration_seconds_count{method="GET",route="/usuarios/{alias}"} 2' in lines
+    assert '# TYPE http_request_sql_queries histogram' in lines
+    # Cada lectura de usuario es una sola consulta.
+    assert 'http_request_sql_queries_sum{method="GET",route="/usuarios/{alias}"} 2.0' in lines
+    assert 'http_request_sql_queries_bucket{method="POST",route="/usuarios/",le="+Inf"} 1' in lines
+
+def test_slow_query_log(monkeypatch):
+    # Caso de prueba: Con umbral activo se registran consulta, parámetros, ruta y plan, marcando escaneos completos
+    from app.routers import debug
+    from app.slowlog import slow_query_log, full_scans
+    assert full_scans(["SCAN rides", "SEARCH users USING INDEX ix_users_alias (alias=?)",
+                       "SCAN rides USING INDEX ix_rides_status_date_id", "SCAN rides_fts VIRTUAL TABLE INDEX 0:M2",
+                       "SCAN CONSTANT ROW", "SCAN (subquery-1)", "SCAN TABLE users AS u"]) == ["SCAN rides", "SCAN TABLE users AS u"]
+    assert client.get("/debug/slow-queries").status_code == 404
+    monkeypatch.setattr(debug, "ADMIN_TOKEN", "secret")
+    assert client.get("/debug/slow-queries", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    monkeypatch.setattr(slow_query_log, "threshold_ms", 0)
+    slow_query_log.clear()
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})
+    client.get("/usuarios/driver")
+    client.get("/rides/search?q=Surco")
+    monkeypatch.setattr(slow_query_log, "threshold_ms", None)
+    response = client.get("/debug/slow-queries", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    records = response.json()["records"]
+    lookup = next(r for r in records if r["route"] == "GET /usuarios/{alias}")
+    assert lookup["parameters"][0] == "driver"
+    assert any("USING INDEX ix_users_alias" in line for line in lookup["plan"])
+    assert lookup["full_scans"] == []
+    listing = client.get("/debug/slow-queries?full_scans_only=true", headers={"X-Admin-Token": "secret"}).json()
+    assert all(record["full_scans"] for record in listing["records"])
+
+def test_query_budget_reports_statements():
+    # Caso de prueba: Al exceder el presupuesto, el error lista las sentencias ejecutadas
+    with pytest.raises(AssertionError) as error:
+        with assert_max_queries(0, "GET /usuarios/{alias}"):
+            client.get("/usuarios/nobody")
+    message = str(error.value)
+    assert "GET /usuarios/{alias} ran 1 queries, budget is 0" in message
+    assert "1. SELECT users.id" in message
+
+def test_query_budgets_cover_every_route():
+    # Caso de prueba: Cada ruta de users.py y rides.py declara su presupuesto de consultas
+    from app.routers import rides, users
+    routes = {f"{method} {route.path}" for router in (users.router, rides.router)
+              for route in router.routes for method in route.methods}
+    assert routes == set(QUERY_BUDGETS)
+
+def test_routes_within_query_budget(query_budget):
+    # Caso de prueba: Ninguna ruta excede su presupuesto con varios rides y participantes cargados
+    query_budget("POST /usuarios/", "/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})
+    query_budget("POST /usuarios/bulk", "/usuarios/bulk",
+                 json=[{"alias": f"p{i}", "name": f"Participant {i}"} for i in range(8)])
+    for _ in range(5):
+        query_budget("POST /usuarios/{alias}/rides", "/usuarios/driver/rides", json={
+            "rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Av Javier Prado 456, San Borja", "allowedSpaces": 4,
+        })
+    for ride_id in range(1, 6):
+        for i in range(8):
+            query_budget("POST /usuarios/{alias}/rides/{ride_id}/requestToJoin/{participant_alias}",
+                         f"/usuarios/driver/rides/{ride_id}/requestToJoin/p{i}",
+                         json={"destination": "Av Arequipa 100, Miraflores", "occupiedSpaces": 1})
+    for i in range(2):
+        assert query_budget("POST /usuarios/{alias}/rides/{ride_id}/accept/{participant_alias}",
+                            f"/usuarios/driver/rides/1/accept/p{i}").status_code == 200
+    for i in range(2, 8):
+        assert query_budget("POST /usuarios/{alias}/rides/{ride_id}/reject/{participant_alias}",
+                            f"/usuarios/driver/rides/1/reject/p{i}").status_code == 200
+
+    assert len(query_budget("GET /usuarios/", "/usuarios/").json()) == 9
+    assert query_budget("GET /usuarios/{alias}", "/usuarios/p0").status_code == 200
+    assert len(query_budget("GET /rides", "/rides").json()) == 5
+    assert len(query_budget("GET /rides/search", "/rides/search?q=borja").json()) == 5
+    assert len(query_budget("GET /usuarios/{alias}/rides", "/usuarios/driver/rides").json()) == 5
+    assert len(query_budget("GET /usuarios/{alias}/participations", "/usuarios/p0/participations").json()) == 5
+    assert query_budget("GET /usuarios/{alias}/rides/match",
+                        "/usuarios/p0/rides/match?destination=San%20Borja&at=2025-07-15T22:00:00").status_code == 200
+    assert len(query_budget("GET /usuarios/{alias}/rides/{ride_id}", "/usuarios/driver/rides/2").json()["participants"]) == 8
+
+    assert query_budget("POST /usuarios/{alias}/rides/{ride_id}/start", "/usuarios/driver/rides/1/start").status_code == 200
+    assert query_budget("POST /usuarios/{alias}/rides/{ride_id}/unloadParticipant",
+                        "/usuarios/p0/rides/1/unloadParticipant").status_code == 200
+    assert query_budget("POST /usuarios/{alias}/rides/{ride_id}/end", "/usuarios/driver/rides/1/end").status_code == 200
+
+def test_profile_request_with_admin_header(monkeypatch):
+    # Caso de prueba: X-Profile de un admin guarda un reporte de cProfile con las consultas SQL, consultable por id
+    from app import profiling
+    from app.routers import debug
+    monkeypatch.setattr(debug, "ADMIN_TOKEN", "secret")
+    profiling.profile_store.clear()
+    admin = {"X-Admin-Token": "secret"}
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant"})
+    client.post("/usuarios/driver/rides", json={
+        "rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3,
+    })
+    client.post("/usuarios/driver/rides/1/requestToJoin/participant",
+                json={"destination": "Participant Destination", "occupiedSpaces": 1})
+    # Sin token de admin el header se ignora.
+    assert "X-Profile-Id" not in client.get("/usuarios/driver", headers={"X-Profile": "1"}).headers
+    response = client.post("/usuarios/driver/rides/1/accept/participant", headers={"X-Profile": "1", **admin})
+    assert response.status_code == 200
+    report_id = response.headers["X-Profile-Id"]
+    report = client.get(f"/debug/profiles/{report_id}", headers=admin).json()
+    assert report["route"] == "/usuarios/{alias}/rides/{ride_id}/accept/{participant_alias}"
+    assert report["status"] == 200 and report["trigger"] == "header"
+    assert report["sql"]["count"] == len(report["sql"]["statements"]) > 0
+    assert any("UPDATE rides" in s["statement"] for s in report["sql"]["statements"])
+    assert any("accept_ride_request" in f["function"] for f in report["functions"])
+    assert [p["id"] for p in client.get("/debug/profiles", headers=admin).json()] == [report_id]
+    assert client.get("/debug/profiles/unknown", headers=admin).status_code == 404
+
+def test_profile_store_is_bounded():
+    # Caso de prueba: El almacén de reportes descarta los más antiguos al llenarse
+    from app.profiling import ProfileStore
+    store = ProfileStore(maxsize=2)
+    for report_id in ("a", "b", "c"):
+        store.add({"id": report_id})
+    assert store.get("a") is None and store.get("c") == {"id": "c"}
+
+def test_group_commit_batches_writes(monkeypatch):
+    # Caso de prueba: Con group commit, escrituras concurrentes se confirman juntas y cada request conserva su resultado
+    from concurrent.futures import ThreadPoolExecutor
+    from app.metrics import registry
+    monkeypatch.setattr(crud.commit_queue, "window_ms", 50)
+    registry.clear()
+
+    def post(args):
+        path, body = args
+        return TestClient(app).post(path, json=body)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        users = [("/usuarios/", {"alias": f"user{i}", "name": f"User {i}"}) for i in range(8)]
+        responses = list(pool.map(post, [("/usuarios/", {"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})] + users))
+    assert [r.status_code for r in responses] == [200] * 9
+    assert len({r.json()["id"] for r in responses}) == 9
+
+    client.post("/usuarios/driver/rides", json={
+        "rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3,
+    })
+    join = {"destination": "Participant Destination", "occupiedSpaces": 1}
+    requests = [(f"/usuarios/driver/rides/1/requestToJoin/user{i}", join) for i in range(6)]
+    # user0 pide dos veces en el mismo lote: solo la segunda falla.
+    requests.append(("/usuarios/driver/rides/1/requestToJoin/user0", join))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(post, requests))
+    assert sorted(r.status_code for r in responses) == [200] * 6 + [422]
+    assert next(r for r in responses if r.status_code == 422).json()["detail"] == \
+        "Participant has already requested to join this ride"
+    assert all(r.json()["participant"]["alias"].startswith("user") for r in responses if r.status_code == 200)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(post, [(f"/usuarios/driver/rides/1/accept/user{i}", None) for i in range(5)]))
+    # Tres cupos: exactamente tres aceptaciones prosperan.
+    assert sorted(r.status_code for r in responses) == [200] * 3 + [422] * 2
+    assert client.get("/usuarios/driver/rides/1").json()["freeSeats"] == 0
+    assert client.post("/usuarios/driver/rides/1/reject/user5").status_code == 200
+
+    lines = client.get("/metrics").text.splitlines()
+    batches = int(next(l for l in lines if l.startswith("group_commit_batch_size_count")).split()[-1])
+    jobs = float(next(l for l in lines if l.startswith("group_commit_batch_size_sum")).split()[-1])
+    assert jobs == 9 + 7 + 5 + 1 and batches < jobs
+    assert any(l.startswith("group_commit_wait_seconds_bucket") for l in lines)
+
+def _bump_version(table: str, row_id: int):
+    # Simula otra request que modifica la fila entre la lectura y la escritura.
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"UPDATE {table} SET version = version + 1 WHERE id = ?", (row_id,))
+
+def test_stale_writes_return_conflict(monkeypatch):
+    # Caso de prueba: Una escritura sobre un ride o participación modificado después de leerlo responde 409 reintentable
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver User", "carPlate": "DRIVE-123"})
+    client.post("/usuarios/", json={"alias": "participant", "name": "Participant User"})
+    client.post(
+        "/usuarios/driver/rides",
+        json={"rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": 3}
+    )
+    client.post(
+        "/usuarios/driver/rides/1/requestToJoin/participant",
+        json={"destination": "Participant Destination", "occupiedSpaces": 1}
+    )
+    get_ride, get_participation = crud.get_ride, crud.get_ride_participation
+
+    def stale_ride(db, ride_id, **kwargs):
+        ride = get_ride(db, ride_id, **kwargs)
+        _bump_version("rides", ride_id)
+        return ride
+
+    def stale_participation(db, ride_id, participant_id):
+        participation = get_participation(db, ride_id, participant_id)
+        _bump_version("ride_participations", participation.id)
+        return participation
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud, "get_ride_participation", stale_participation)
+        response = client.post("/usuarios/driver/rides/1/accept/participant")
+        assert response.status_code == 409
+        assert response.headers["retry-after"] == "0"
+        assert response.json()["detail"]["code"] == "write_conflict"
+        assert response.json()["detail"]["retryable"] is True
+        assert client.post("/usuarios/driver/rides/1/reject/participant").status_code == 409
+    # El reintento lee la versión actual y prospera; el cupo se reservó una sola vez.
+    assert client.post("/usuarios/driver/rides/1/accept/participant").status_code == 200
+    assert client.get("/usuarios/driver/rides/1").json()["freeSeats"] == 2
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud, "get_ride", stale_ride)
+        assert client.post("/usuarios/driver/rides/1/start").status_code == 409
+    assert client.post("/usuarios/driver/rides/1/start").status_code == 200
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud, "get_ride_participation", stale_participation)
+        assert client.post("/usuarios/participant/rides/1/unloadParticipant").status_code == 409
+    assert client.post("/usuarios/participant/rides/1/unloadParticipant").status_code == 200
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud, "get_ride", stale_ride)
+        assert client.post("/usuarios/driver/rides/1/end").status_code == 409
+    assert client.post("/usuarios/driver/rides/1/end").status_code == 200
+    assert client.get("/usuarios/driver/rides/1").json()["status"] == "done"
+
+@pytest.mark.parametrize("window_ms", [0, 5])
+def test_concurrent_accept_and_reject_lose_no_updates(monkeypatch, window_ms):
+    # Caso de prueba: Aceptaciones y rechazos concurrentes, reintentados tras un 409, no pierden actualizaciones
+    from concurrent.futures import ThreadPoolExecutor
+    from app.models.models import Ride, RideParticipation
+    monkeypatch.setattr(crud.commit_queue, "window_ms", window_ms)
+    participants, allowed = 12, 8
+    client.post("/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"})
+    client.post("/usuarios/bulk", json=[{"alias": f"user{i}", "name": f"User {i}"} for i in range(participants)])
+    client.post("/usuarios/driver/rides", json={
+        "rideDateAndTime": "2025-07-15T22:00:00", "finalAddress": "Test Address", "allowedSpaces": allowed,
+    })
+    for i in range(participants):
+        client.post(f"/usuarios/driver/rides/1/requestToJoin/user{i}",
+                    json={"destination": "Destination", "occupiedSpaces": 1 + i % 2})
+
+    def post(path):
+        # Reintenta como lo haría un cliente mientras la respuesta sea 409.
+        local = TestClient(app)
+        conflicts = 0
+        while True:
+            response = local.post(path)
+            if response.status_code != 409:
+                return response.status_code, conflicts
+            assert response.json()["detail"]["retryable"] is True
+            conflicts += 1
+
+    # Cada participante recibe una aceptación y un rechazo que compiten entre sí.
+    paths = [f"/usuarios/driver/rides/1/{action}/user{i}" for i in range(participants) for action in ("accept", "reject")]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(post, paths))
+    assert all(status in (200, 422) for status, _ in results)
+    succeeded = sum(status == 200 for status, _ in results)
+    # Exactamente una de las dos requests de cada participante cambia su estado.
+    assert succeeded == participants
+
+    db = TestingSessionLocal()
+    try:
+        ride = db.get(Ride, 1)
+        participations = db.query(RideParticipation).all()
+        assert {p.status for p in participations} <= {"confirmed", "rejected"}
+        assert all(p.version == 2 for p in participations)
+        confirmed = sum(p.occupiedSpaces for p in participations if p.status == "confirmed")
+        assert ride.confirmedSpaces == confirmed <= allowed
+        # Cada escritura exitosa (solicitudes y decisiones) incrementó la versión del ride una vez.
+        assert ride.version == 1 + participants + succeeded
+    finally:
+        db.close()
+
+def test_group_commit_counts_sql_per_request(monkeypatch):
+    # Caso de prueba: Con group commit, las sentencias del writer se atribuyen a la request que las envió
+    from app import profiling
+    from app.metrics import registry
+    from app.routers import debug
+    monkeypatch.setattr(debug, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(crud.commit_queue, "window_ms", 5)
+    admin = {"X-Admin-Token": "secret", "X-Profile": "1"}
+    registry.clear()
+    response = client.post("/usuarios/", json={"alias": "driver", "name": "Driver", "carPlate": "ABC-123"},
+                           headers=admin)
+    assert response.status_code == 200
+    statements = [s["statement"] for s in profiling.profile_store.get(response.headers["X-Profile-Id"])["sql"]["statements"]]
+    # El SELECT del alias corre en la request y el INSERT en el writer; BEGIN y SAVEPOINT no se cuentan.
+    assert len(statements) == 2 and statements[1].startswith("INSERT INTO users")
+    lines = client.get("/metrics").text.splitlines()
+    assert 'http_request_sql_queries_sum{method="POST",route="/usuarios/"} 2.0' in lines